@@ -1,72 +1,241 @@
 from flask import Flask, request, send_file, render_template, jsonify
 import socket
 import base64
-import cv2
-import numpy as np
 import time
 import os
 import threading
+import uuid
+import asyncio
+
+import protocol
 
 app = Flask(__name__)
 
 # Dictionary to store the status of each image processing request
 processing_status = {}
 
-def send_request(filename, operation, host, port, request_id):
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.connect((host, port))
-    print("Image is being processed .....")
-    with open(filename, "rb") as f:
-        img_data = f.read(8192)
-        while img_data:
-            client_socket.send(img_data)
-            img_data = f.read(8192)
+# File extension for each output format the server can return
+RESULT_EXTENSIONS = {"jpeg": "jpg", "png": "png", "webp": "webp", "raw": "raw"}
 
-    message = b"IMAGE SENT"
-    client_socket.send(message)
+# Keep-alive connections per master and requests each may have in flight
+POOL_SIZE = 4
+MAX_PIPELINED = 8
 
-    message = client_socket.recv(8192)
-    if message == b"IMAGE RECEIVED":
-        print("Server received image safely")
-        client_socket.send(f"{operation}".encode())
+# Seconds to wait for a response before giving up on a request
+REQUEST_TIMEOUT = 300
 
-    message = client_socket.recv(8192).decode()
-    print(message)
 
-    client_socket.send(b"operation request is sent successfully, waiting for image to be processed")
+class MasterConnection:
+    """A keep-alive connection to the master with several requests in flight."""
 
-    processed_img_bytes = b""
-    while True:
-        chunk = client_socket.recv(8192)
-        if not chunk:
-            break
-        processed_img_bytes += chunk
-        if b"DONE" in chunk:
-            print("Processed image received at client")
-            client_socket.send(b"CLIENT_DONE")
-            break
+    def __init__(self, reader, writer, max_pipelined):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}
+        self.slots = asyncio.Semaphore(max_pipelined)
+        self.closed = False
+        self.reader_task = asyncio.create_task(self.read_responses())
+
+    @classmethod
+    async def open(cls, host, port, max_pipelined):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer, max_pipelined)
+
+    @property
+    def load(self):
+        return len(self.pending)
+
+    async def read_responses(self):
+        # Responses can arrive in any order; the request id says whose they are
+        try:
+            while True:
+                response = await protocol.read_message(self.reader)
+                future = self.pending.pop(response.request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (asyncio.IncompleteReadError, ConnectionError, protocol.ProtocolError):
+            pass
+        finally:
+            self.closed = True
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection to the master was closed"))
+            self.pending.clear()
+
+    async def request(self, operation, payload, params=None):
+        async with self.slots:
+            if self.closed:
+                raise ConnectionError("Connection to the master was closed")
+            request_id = uuid.uuid4().bytes
+            future = asyncio.get_running_loop().create_future()
+            self.pending[request_id] = future
+            try:
+                await protocol.write_message(self.writer, protocol.MSG_REQUEST, operation, request_id, params,
+                                             payload)
+                return await asyncio.wait_for(future, REQUEST_TIMEOUT)
+            finally:
+                # A late response for a request given up on is dropped by read_responses
+                self.pending.pop(request_id, None)
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+        await self.reader_task
+
+
+class AsyncClientPool:
+    """Pool of MasterConnections for asyncio code.
+
+    Each request goes to the least loaded connection. A new connection is
+    opened while all existing ones are busy, up to size. A request that
+    hits a connection the master already closed is retried once on a
+    fresh connection.
+    """
+
+    def __init__(self, host, port, size=POOL_SIZE, max_pipelined=MAX_PIPELINED):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.max_pipelined = max_pipelined
+        self.connections = []
+        self.lock = asyncio.Lock()
+
+    async def get_connection(self):
+        async with self.lock:
+            self.connections = [connection for connection in self.connections if not connection.closed]
+            connection = min(self.connections, key=lambda c: c.load, default=None)
+            if connection is None or (connection.load and len(self.connections) < self.size):
+                connection = await MasterConnection.open(self.host, self.port, self.max_pipelined)
+                self.connections.append(connection)
+            return connection
+
+    async def process(self, operation, payload, params=None):
+        for attempt in range(2):
+            connection = await self.get_connection()
+            try:
+                return await connection.request(operation, payload, params)
+            except ConnectionError:
+                if attempt:
+                    raise
+
+    async def close(self):
+        connections, self.connections = self.connections, []
+        await asyncio.gather(*(connection.close() for connection in connections))
+
+
+class ClientPool:
+    """Blocking front for AsyncClientPool, driven by an event loop on its own thread."""
+
+    def __init__(self, host, port, size=POOL_SIZE, max_pipelined=MAX_PIPELINED):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.pool = AsyncClientPool(host, port, size, max_pipelined)
+
+    def submit(self, operation, payload, params=None):
+        # Returns a concurrent.futures.Future so callers can keep several requests outstanding
+        return asyncio.run_coroutine_threadsafe(self.pool.process(operation, payload, params), self.loop)
+
+    def process(self, operation, payload, params=None):
+        return self.submit(operation, payload, params).result()
 
-    if not processed_img_bytes:
-        print("Error: Did not receive any image data from server.")
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.pool.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+client_pools = {}
+client_pools_lock = threading.Lock()
+
+
+def get_client_pool(host, port):
+    with client_pools_lock:
+        if (host, port) not in client_pools:
+            client_pools[(host, port)] = ClientPool(host, port)
+        return client_pools[(host, port)]
+
+def send_request(filename, operation, host, port, request_id, params=None):
+    print("Image is being processed .....")
+    with open(filename, "rb") as f:
+        img_data = f.read()
+
+    try:
+        response = get_client_pool(host, port).process(operation, img_data, params)
+    except asyncio.TimeoutError:
+        print(f"Error: the master did not answer within {REQUEST_TIMEOUT} seconds")
+        processing_status[request_id] = "error"
+        return
+    except (OSError, protocol.ProtocolError) as e:
+        print(f"Error: could not reach the master: {e}")
+        processing_status[request_id] = "error"
+        return
+
+    if response.status != protocol.STATUS_OK or not response.payload:
+        print(f"Error: {response.params.get('error', 'Did not receive any image data from server.')}")
         processing_status[request_id] = "error"
         return
 
-    processed_img_bytes = processed_img_bytes[:-len(b"DONE")]
+    print("Processed image received at client")
+    processed_img_bytes = response.payload
 
-    img_array = np.frombuffer(processed_img_bytes, dtype=np.uint8)
-    processed_img = cv2.imdecode(img_array, flags=cv2.IMREAD_COLOR)
-    if processed_img is not None and processed_img.size > 0:
-        timestamp = int(time.time())
-        processed_filename = f"processed_image_{timestamp}.jpg"
-        cv2.imwrite(processed_filename, processed_img)
-        processing_status[request_id] = processed_filename
+    # A request for several outputs gets them back to back in one payload
+    outputs = response.params.get("outputs", [dict(response.params, length=len(processed_img_bytes))])
+    timestamp = int(time.time())
+    offset = 0
+    for output, output_params in enumerate(outputs):
+        # The server already encoded the result in the requested format; keep its bytes as they are
+        extension = RESULT_EXTENSIONS.get(output_params.get("format"), "jpg")
+        suffix = f"_{output}" if len(outputs) > 1 else ""
+        processed_filename = f"processed_image_{timestamp}{suffix}.{extension}"
+        with open(processed_filename, "wb") as f:
+            f.write(processed_img_bytes[offset:offset + output_params["length"]])
+        offset += output_params["length"]
+        if output == 0:
+            processing_status[request_id] = processed_filename
+        if output_params.get("format") == "raw":
+            print(f"Raw pixels are {output_params['dtype']} with shape {output_params['shape']}.")
         print(f"Processed image saved as {processed_filename} successfully.")
-    else:
-        print("Error: Invalid image dimensions.")
-        processing_status[request_id] = "error"
+
+def send_batch_request(filenames, operations, host, port, params=None):
+    # Runs every operation on every image over one connection and returns a status per result
+    images = []
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            images.append(f.read())
+    batch_params = dict(params or {}, operations=operations, items=[len(data) for data in images])
+
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_socket.connect((host, port))
+    # Applies to each response, so a long batch only fails if the master stalls
+    client_socket.settimeout(REQUEST_TIMEOUT)
+    print(f"Batch of {len(filenames)} images is being processed .....")
+    protocol.send_message(client_socket, protocol.MSG_BATCH_REQUEST, operations[0], uuid.uuid4().bytes,
+                          batch_params, b"".join(images))
+
+    results = []
+    timestamp = int(time.time())
+    while True:
+        response = protocol.recv_message(client_socket)
+        if response.kind == protocol.MSG_BATCH_DONE or "item" not in response.params:
+            break
+        item = response.params["item"]
+        result = {"filename": filenames[item], "operation": response.operation}
+        if response.status != protocol.STATUS_OK:
+            result.update(status="error", error=response.params.get("error"))
+            print(f"Error: {filenames[item]} ({response.operation}): {result['error']}")
+        else:
+            extension = RESULT_EXTENSIONS.get(response.params.get("format"), "jpg")
+            processed_filename = f"processed_image_{timestamp}_{item}+{response.operation}.{extension}"
+            with open(processed_filename, "wb") as f:
+                f.write(response.payload)
+            result.update(status="ok", saved_as=processed_filename)
+        results.append(result)
 
     client_socket.close()
-    print("Socket closed.")
+    print(f"Batch done: {sum(result['status'] == 'ok' for result in results)} of {len(results)} results saved.")
+    return results
 
 @app.route('/', methods=['GET'])
 def index():
@@ -163,11 +332,33 @@ def index():
               <option value="edge_detection">Edge Detection</option>
               <option value="thresholding">Thresholding</option>
               <option value="histogram_equalization">Histogram Equalization</option>
+              <option value="clahe">Adaptive Equalization (CLAHE)</option>
               <option value="rotation_left">Rotate Left</option>
               <option value="rotation_right">Rotate Right</option>
               <option value="corner_detection">Corner Detection</option>
               <option value="deblurring">Deblurring</option>
             </select><br><br>
+            <label for="engine">Distribution:</label>
+            <select id="engine" name="engine">
+              <option value="">Default (shared)</option>
+              <option value="p2p">Point-to-point</option>
+              <option value="collective">Scatter/Gather</option>
+            </select><br><br>
+            <label for="format">Output format:</label>
+            <select id="format" name="format">
+              <option value="">Default</option>
+              <option value="jpeg">JPEG</option>
+              <option value="png">PNG</option>
+              <option value="webp">WebP</option>
+            </select>
+            <label for="quality">Quality:</label>
+            <input type="text" id="quality" name="quality" size="3"><br><br>
+            <label for="preset">Deblurring preset:</label>
+            <select id="preset" name="preset">
+              <option value="">Balanced</option>
+              <option value="fast">Fast</option>
+              <option value="quality">Quality</option>
+            </select><br><br>
             <div id="scalingFields" style="display:none;">
               <label for="width">Width:</label>
               <input type="text" id="width" name="width"><br><br>
@@ -191,6 +382,8 @@ def index():
 def process_image():
     filename = request.form['filename']
     operation = request.form['operation']
+    params = {key: request.form[key] for key in ('engine', 'width', 'height', 'format', 'quality', 'preset')
+              if request.form.get(key)}
     host = '13.38.35.41'  # Replace with your EC2 instance's public IP address
     port = 10240  # Same port number used in the server code
 
@@ -199,7 +392,7 @@ def process_image():
     processing_status[request_id] = "processing"
 
     # Start the image processing in a separate thread
-    thread = threading.Thread(target=send_request, args=(filename, operation, host, port, request_id))
+    thread = threading.Thread(target=send_request, args=(filename, operation, host, port, request_id, params))
     thread.start()
 
     return jsonify(request_id=request_id)
@@ -207,7 +400,7 @@ def process_image():
 @app.route('/status/<request_id>', methods=['GET'])
 def status(request_id):
     status = processing_status.get(request_id, "unknown")
-    if status.endswith(".jpg"):
+    if status.startswith("processed_image_"):
         status = "complete"
     elif status == "error":
         status = "error"
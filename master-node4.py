@@ -8,6 +8,23 @@ import subprocess
 import logging
 import sys
 import threading
+import queue
+import asyncio
+import zlib
+import struct
+import copy
+import math
+import argparse
+import weakref
+import multiprocessing
+
+import operations
+import protocol
+import result_cache
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -16,58 +33,501 @@ comm = MPI.COMM_WORLD
 rank = comm.Get_rank()
 size = comm.Get_size()
 
-CHUNK_SIZE = 1024 * 1024
-
-
-def process_image(img_data, operation, width=None, height=None):
-    # Convert the bytes to a NumPy array
-    img_array = np.frombuffer(img_data, dtype=np.uint8)
-
-    # Decode the image array to get its dimensions and channels
-    img = cv2.imdecode(img_array, flags=cv2.IMREAD_COLOR)
-
-    # Perform the specified image processing operation
-    if operation == "grayscale":
-        processed_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    elif operation == "blur":
-        processed_img = cv2.GaussianBlur(img, (5, 5), 0)
-    elif operation == "edge_detection":
-        gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        processed_img = cv2.Canny(gray_img, 100, 200)
-    elif operation == "edge_detection":
-        gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        processed_img = cv2.Canny(gray_img, 100, 200)  # Canny edge detection
-    elif operation == "thresholding":
-        ret, processed_img = cv2.threshold(img, 127, 255, cv2.THRESH_BINARY)
-    elif operation == "histogram_equalization":
-        gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        processed_img = cv2.equalizeHist(gray_img)
-    elif operation == "rotation_left":
-        rows, cols = img.shape[:2]
-        rotation_matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), 90, 1)  # Rotate left
-        processed_img = cv2.warpAffine(img, rotation_matrix, (cols, rows))
-    elif operation == "rotation_right":
-        rows, cols = img.shape[:2]
-        rotation_matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), -90, 1)  # Rotate right
-        processed_img = cv2.warpAffine(img, rotation_matrix, (cols, rows))
-    elif operation == "scaling":
-        if width is None or height is None:
-            raise ValueError("Width and height must be specified for scaling operation")
-        processed_img = cv2.resize(img, (width, height))
-    elif operation == "corner_detection":
-        gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        dst = cv2.cornerHarris(gray_img, 2, 3, 0.04)  # Corner detection
-        dst = cv2.dilate(dst, None)
-        processed_img = img.copy()
-        processed_img[dst > 0.01 * dst.max()] = [0, 0, 255]  # Mark corners in red
-    elif operation == "deblurring":
-        processed_img = cv2.fastNlMeansDenoisingColored(img, None, 10, 10, 7, 21)  # Deblurring
+TILE_SIZE = 1024  # Default tile edge length in pixels; expensive operations ask for smaller tiles
+
+# How tiles are assigned to slaves: "block", "cyclic" or "weighted"
+PARTITION_STRATEGY = "block"
+
+# How tile pixels travel between ranks. Either way they are never run
+# through an image codec; only the final stitched image is encoded.
+# "raw" sends the NumPy buffer as is, "zlib" deflates it first, which is
+# worth it on slow links. The collective engine always sends raw bytes.
+TRANSPORT = "raw"
+TILE_COMPRESSION_LEVEL = 1
+
+# Default distribution engine: "shared" interleaves tiles from every queued
+# job across the slave pool, one tile per slave at a time. The remaining
+# engines take over all slaves for a single job: "p2p" sends tiles with point-to-point messages,
+# "collective" hands out row bands with Scatterv/Gatherv and "pipelined" keeps
+# a window of tiles in flight per slave with Isend/Irecv and "dynamic" hands
+# the next queued tile to whichever slave finishes first. Clients can pick one
+# per job with the "engine" request parameter.
+DISTRIBUTION_ENGINE = "shared"
+DISTRIBUTION_ENGINES = ("shared", "p2p", "collective", "pipelined", "dynamic")
+
+# Tiles each slave may have outstanding in the pipelined engine
+PIPELINE_WINDOW = 2
+
+# The small tiles the dynamic engine queues at the end of a job have this
+# fraction of the job's tile edge length
+TAIL_TILE_DIVISOR = 4
+
+# Where jobs run: "mpi" spreads tiles over slave ranks, "local" over a pool
+# of worker processes on this machine, which needs neither mpirun nor slave
+# hosts. "auto" picks "mpi" when started with more than one rank or when
+# slave hosts answer, and "local" otherwise. Overridden by --backend on the
+# command line. The local backend has no dispatcher and no distribution
+# engines: every job's tiles join the pool's one queue and go to whichever
+# worker is free, and the "engine", "transport" and "window" request
+# parameters are ignored.
+EXECUTION_BACKEND = "auto"
+
+# Worker processes of the local backend; None for one per core
+LOCAL_WORKERS = None
+
+# Threads each slave rank processes sub-tiles on. None shares the node's
+# cores evenly between the ranks the MPI launcher placed on it.
+WORKER_THREADS = None
+
+# Slaves do not cut a block into sub-tiles smaller than this
+MIN_SUB_TILE_SIZE = 128
+
+# Sub-tile thread pool of a slave rank, started by start_worker_pool
+worker_pool = None
+worker_threads = 1
+
+# Tiles processed by each slave rank under the dynamic engine, across all jobs
+worker_tile_counts = {}
+
+# Batch items a single batch may have decoded and queued at once
+BATCH_MAX_IN_FLIGHT = 64
+
+# Pending connections the front-end lets the kernel queue during bursts
+SERVER_BACKLOG = 1024
+
+# File extension for each output format a request can ask for; "raw"
+# returns the stitched pixel buffer with its shape and dtype in the response
+OUTPUT_FORMATS = {"jpeg": ".jpg", "png": ".png", "webp": ".webp", "raw": ".raw"}
+
+# Output format used when a request does not name one. Binary masks are far
+# smaller as PNG and PNG at its default compression level is cheap to encode.
+# Corner coordinates are not an image and only make sense raw.
+DEFAULT_OUTPUT_FORMATS = {"edge_detection": "png", "thresholding": "png", "corner_points": "raw"}
+
+# Let decoding skip work the job does not need: a JPEG's DCT-domain reduced
+# decode when every output starts by scaling down far enough. Requests can
+# opt out with "fast_decode": false.
+DECODE_FAST_PATHS = True
+
+# Decode with IMREAD_GRAYSCALE when every output starts from luminance.
+# The codec's own luminance can differ by a few levels from converting a
+# color decode, which changes results, so this is off unless a request
+# sets "gray_decode": true.
+GRAYSCALE_DECODE = False
+
+# Reduced decode modes, largest reduction first
+REDUCED_DECODE_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                        (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+# JPEG start-of-frame markers, which carry the image dimensions
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# Where results are kept when a request sets the "save" parameter
+RESULTS_DIR = "processed_images"
+
+# Encoded results are cached by the front-end under a hash of the input
+# image, the operation and the request parameters, so retries and duplicate
+# uploads skip the job. Recently used results stay in memory within the
+# first budget and spill to RESULT_CACHE_DIR within the second; a budget of
+# 0 turns that tier off. Requests can bypass the cache with "cache": false.
+RESULT_CACHE_MEMORY_BYTES = 256 * 1024 * 1024
+RESULT_CACHE_DISK_BYTES = 2 * 1024 * 1024 * 1024
+RESULT_CACHE_DIR = "result_cache"
+
+# Request parameters that do not change the result, left out of cache keys
+CACHE_IGNORED_PARAMS = {"save", "cache", "engine", "transport", "window"}
+
+# Cache lookups between hit/miss reports in the log
+CACHE_REPORT_INTERVAL = 100
+
+# Front-end result cache, created by serve_clients
+cache = None
+
+# Futures of cached requests being computed, by cache key
+pending_results = {}
+
+# One lock per client connection, held while a whole response frame is written
+write_locks = {}
+
+# Seconds the dispatcher waits for new jobs while slaves are busy
+DISPATCH_POLL_INTERVAL = 0.001
+
+# Jobs submitted by client handler threads, consumed by the dispatcher thread
+job_queue = queue.Queue()
+
+# Tags for the pixel payloads that follow a pickled tile header
+TILE_DATA_TAG = 6
+RESULT_DATA_TAG = 7
+
+# Slaves report their host name on this tag when they start
+HOST_TAG = 8
+
+# Slaves on rank 0's host map the job's image from shared memory and only
+# the location of each tile travels over MPI. The collective engine still
+# scatters bands through MPI.
+SHARED_MEMORY = True
+
+# Slave ranks on rank 0's host, filled in by the dispatcher at startup
+shared_memory_peers = set()
+
+# Rank 0: segments holding job images, as name -> (segment, base address, size)
+shared_segments = {}
+# Segments that still have arrays viewing them and close on a later try
+retired_segments = {}
+# Slaves: segments attached for the current job
+attached_segments = {}
+# Segment name -> weak reference to the byte array over the whole segment.
+# Every array on a segment is a view of its root, so the root stays alive
+# exactly as long as something still points into the segment.
+segment_roots = {}
+# Set in local backend worker processes, which share rank 0's resource tracker
+local_worker = False
+
+# core and padded are (y0, y1, x0, x1) bounds in whole-image coordinates
+Tile = namedtuple("Tile", ["index", "core", "padded", "pixels"])
+
+
+def jpeg_size(data):
+    # Reads (width, height) from a JPEG's frame header without decoding it;
+    # None for anything that is not a JPEG
+    data = memoryview(data)
+    if bytes(data[:2]) != b"\xff\xd8":
+        return None
+    offset = 2
+    while offset + 9 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            offset += 1  # fill byte
+        elif marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack_from(">HH", data, offset + 5)
+            return width, height
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            offset += 2  # markers without a length field
+        else:
+            offset += 2 + struct.unpack_from(">H", data, offset + 2)[0]
+    return None
+
+
+def decode_flags(data, job, options):
+    # Cheapest imdecode mode that still gives every output what it needs
+    if not options.get("fast_decode", DECODE_FAST_PATHS):
+        return cv2.IMREAD_COLOR
+    pipelines = operations.compile_outputs(job["outputs"]).pipelines
+    if options.get("gray_decode", GRAYSCALE_DECODE) and all(
+            pipeline.input_space == "gray" for pipeline in pipelines):
+        return cv2.IMREAD_GRAYSCALE
+
+    first_steps = [pipeline.steps[0] for pipeline in pipelines]
+    if not all(operation.name == "scaling" for operation, _ in first_steps):
+        return cv2.IMREAD_COLOR
+    size = jpeg_size(data)
+    if size is None:
+        return cv2.IMREAD_COLOR
+    width, height = size
+    for factor, flags in REDUCED_DECODE_FLAGS:
+        # The decoder rounds reduced dimensions up; never go below a target
+        # size. The frame header gives the stored size, and an EXIF
+        # orientation may swap it on decode, so both ways round must fit.
+        reduced_edge = min(-(-width // factor), -(-height // factor))
+        if all(reduced_edge >= max(params["width"], params["height"]) for _, params in first_steps):
+            return flags
+    return cv2.IMREAD_COLOR
+
+
+def decode_image(data, job, options):
+    flags = decode_flags(data, job, options)
+    start = time.time()
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+    if img is not None:
+        logging.debug(f"Decoded {img.shape} with imdecode flags {flags} in {time.time() - start:.3f}s")
+    return img
+
+
+def apply_job(pixels, job, core=None):
+    # Run every step of the job's pipelines over one tile in a single pass.
+    # Jobs with several outputs return a list with one array per output, and
+    # measuring jobs return the statistic of the tile's core. The master
+    # applies each operation's finish step once the tiles are stitched.
+    if job.get("measure"):
+        return operations.compile_pipeline(job["outputs"][0]).measure(pixels, core)
+
+    output_set = operations.compile_outputs(job["outputs"])
+    # Steps still waiting for a whole-image statistic measure the block they
+    # are given, so such blocks must stay in one piece
+    splittable = output_set.halo is not None and all(
+        pipeline.unresolved() is None for pipeline in output_set.pipelines)
+    if worker_pool is not None and splittable:
+        # About two sub-tiles per thread so uneven ones even out
+        height, width = pixels.shape[:2]
+        edge = max(MIN_SUB_TILE_SIZE, int(math.sqrt(height * width / (2 * worker_threads))))
+        sub_tiles = split_into_tiles(pixels, output_set.halo, edge)
+    else:
+        sub_tiles = []
+
+    if len(sub_tiles) > 1:
+        # OpenCV's own threads would compete with the pool's for the same cores
+        cv2.setNumThreads(1)
+        try:
+            results = list(worker_pool.map(lambda tile: output_set(tile.pixels), sub_tiles))
+        finally:
+            cv2.setNumThreads(worker_threads)
+        results = stitch_tiles(pixels.shape, sub_tiles, results)
+    else:
+        results = output_set(pixels)
+    return results if len(results) > 1 else results[0]
+
+
+def local_rank_count():
+    # Ranks sharing this node, as reported by the MPI launcher
+    for variable in ("OMPI_COMM_WORLD_LOCAL_SIZE", "MPI_LOCALNRANKS"):
+        if os.environ.get(variable, "").isdigit():
+            return int(os.environ[variable])
+    return 1
+
+
+def start_worker_pool():
+    # Slaves split each block across threads; OpenCV releases the GIL, so
+    # one rank per node can keep every core busy
+    global worker_pool, worker_threads
+    worker_threads = WORKER_THREADS or max(1, (os.cpu_count() or 1) // local_rank_count())
+    # Whole blocks use OpenCV's threads, limited to this rank's share of the node
+    cv2.setNumThreads(worker_threads)
+    if worker_threads > 1:
+        worker_pool = ThreadPoolExecutor(max_workers=worker_threads)
+    logging.info(f"Slave node {rank} processes sub-tiles on {worker_threads} threads.")
+
+
+def apply_tile(tile_index, pixels, job):
+    return apply_job(pixels, job, job["cores"][tile_index] if "cores" in job else None)
+
+
+def split_into_tiles(img, halo, tile_size=TILE_SIZE, tail_tile_size=None):
+    height, width = img.shape[:2]
+    if halo is None:
+        bounds = (0, height, 0, width)
+        return [Tile(0, bounds, bounds, img)]
+
+    # Optionally cut the last strip of rows into smaller tiles so a dynamic
+    # scheduler still has fine-grained work left near the end of a job
+    tail_start = max(height - tile_size, 0) if tail_tile_size else height
+    strips = [(y0, min(y0 + tile_size, tail_start), tile_size) for y0 in range(0, tail_start, tile_size)]
+    strips += [(y0, min(y0 + tail_tile_size, height), tail_tile_size)
+               for y0 in range(tail_start, height, tail_tile_size or 1)]
+
+    tiles = []
+    for y0, y1, step in strips:
+        for x0 in range(0, width, step):
+            x1 = min(x0 + step, width)
+            padded = (max(y0 - halo, 0), min(y1 + halo, height), max(x0 - halo, 0), min(x1 + halo, width))
+            pixels = img[padded[0]:padded[1], padded[2]:padded[3]]
+            tiles.append(Tile(len(tiles), (y0, y1, x0, x1), padded, pixels))
+    return tiles
+
+
+def tile_cores(tiles):
+    # Core of each tile relative to its padded pixels, for measuring jobs
+    cores = []
+    for tile in tiles:
+        y0, y1, x0, x1 = tile.core
+        top, left = tile.padded[0], tile.padded[2]
+        cores.append((y0 - top, y1 - top, x0 - left, x1 - left))
+    return cores
+
+
+def with_cores(job, tiles):
+    return dict(job, cores=tile_cores(tiles)) if job.get("measure") else job
+
+
+def collect_tiles(shape, tiles, results, job):
+    # Measuring jobs hand back one statistic per tile instead of an image
+    if job.get("measure"):
+        return results
+    return stitch_tiles(shape, tiles, results)
+
+
+def stitch_tiles(shape, tiles, results):
+    # Operations dispatched as a single tile may change the image geometry
+    if len(tiles) == 1:
+        return results[0]
+    if isinstance(results[0], list):
+        return [stitch_tiles(shape, tiles, [result[output] for result in results])
+                for output in range(len(results[0]))]
+
+    output = None
+    for tile, result in zip(tiles, results):
+        y0, y1, x0, x1 = tile.core
+        top, left = y0 - tile.padded[0], x0 - tile.padded[2]
+        if output is None:
+            output = np.empty(shape[:2] + result.shape[2:], dtype=result.dtype)
+        output[y0:y1, x0:x1] = result[top:top + (y1 - y0), left:left + (x1 - x0)]
+    return output
+
+
+def partition_tiles(tiles, num_workers, strategy=PARTITION_STRATEGY):
+    # Returns one list of tile indices per worker; every tile goes to exactly one worker
+    assignments = [[] for _ in range(num_workers)]
+    if strategy == "block":
+        per_worker, remainder = divmod(len(tiles), num_workers)
+        start = 0
+        for worker in range(num_workers):
+            end = start + per_worker + (1 if worker < remainder else 0)
+            assignments[worker] = [tile.index for tile in tiles[start:end]]
+            start = end
+    elif strategy == "cyclic":
+        for tile in tiles:
+            assignments[tile.index % num_workers].append(tile.index)
+    elif strategy == "weighted":
+        # Largest tiles first, each to the worker with the fewest pixels so far
+        loads = [0] * num_workers
+        for tile in sorted(tiles, key=lambda t: t.pixels.size, reverse=True):
+            worker = loads.index(min(loads))
+            assignments[worker].append(tile.index)
+            loads[worker] += tile.pixels.size
+    else:
+        raise ValueError(f"Unknown partition strategy: {strategy}")
+    return assignments
+
+
+def share_image(img):
+    # Copies img into a new shared memory segment; tiles cut from the copy
+    # can be sent to co-located slaves by location alone
+    close_segments(retired_segments)
+    segment = shared_memory.SharedMemory(create=True, size=max(img.nbytes, 1))
+    shared = np.ndarray(img.shape, dtype=img.dtype, buffer=segment_root(segment))
+    shared[...] = img
+    shared_segments[segment.name] = (segment, shared.__array_interface__["data"][0], img.nbytes)
+    return shared, segment
+
+
+def release_image(segment):
+    # Slaves are done with the segment once the job has finished
+    del shared_segments[segment.name]
+    segment.unlink()
+    retired_segments[segment.name] = segment
+    close_segments(retired_segments)
+
+
+def segment_root(segment):
+    root = segment_roots[segment.name]() if segment.name in segment_roots else None
+    if root is None:
+        root = np.ndarray(segment.size, dtype=np.uint8, buffer=segment.buf)
+        segment_roots[segment.name] = weakref.ref(root)
+    return root
+
+
+def close_segments(segments):
+    # Closing unmaps the segment even under live arrays, so segments whose
+    # root is still alive stay for a later try
+    for name, segment in list(segments.items()):
+        if name in segment_roots and segment_roots[name]() is not None:
+            continue
+        segment_roots.pop(name, None)
+        segment.close()
+        del segments[name]
+
+
+def locate_shared(pixels):
+    # (segment name, byte offset, strides) of an array inside a shared job image
+    if not isinstance(pixels, np.ndarray):
+        return None
+    address = pixels.__array_interface__["data"][0]
+    for segment, base, nbytes in list(shared_segments.values()):
+        if base <= address < base + nbytes:
+            return segment.name, address - base, pixels.strides
+    return None
+
+
+def shared_tile_header(tile_index, pixels):
+    # Header locating a tile of a shared job image, or None if it is not in one
+    location = locate_shared(pixels)
+    if location is None:
+        return None
+    return tile_index, pixels.shape, pixels.dtype.str, 0, location
+
+
+def attach_shared(header):
+    tile_index, shape, dtype, _, (name, offset, strides) = header
+    if name not in attached_segments:
+        try:
+            attached_segments[name] = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 attaching also registers the segment for
+            # removal when this process exits, but rank 0 owns it. Local
+            # backend workers inherit rank 0's tracker (LocalBackend.start
+            # runs it before forking), so there the entry is rank 0's own
+            attached_segments[name] = shared_memory.SharedMemory(name=name)
+            if not local_worker:
+                resource_tracker.unregister(attached_segments[name]._name, "shared_memory")
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment_root(attached_segments[name]), offset=offset,
+                      strides=strides)
+
+
+def pack_tile(tile_index, pixels, codec, dest=None):
+    # Returns the pickled header and the byte buffer that goes on the wire.
+    # A list of arrays (one per job output) travels as one buffer, with a
+    # list of shapes and dtypes in the header. A tile of a shared job image
+    # bound for a co-located slave has no buffer; its header says where it is.
+    if dest in shared_memory_peers:
+        header = shared_tile_header(tile_index, pixels)
+        if header is not None:
+            return header, None
+
+    if isinstance(pixels, list):
+        arrays = [np.ascontiguousarray(array) for array in pixels]
+        shape, dtype = [array.shape for array in arrays], [array.dtype.str for array in arrays]
+        pixels = np.concatenate([array.reshape(-1).view(np.uint8) for array in arrays])
     else:
-        processed_img = img  # If no operation specified, return original image
+        pixels = np.ascontiguousarray(pixels)
+        shape, dtype = pixels.shape, pixels.dtype.str
+    if codec == "zlib":
+        wire = np.frombuffer(zlib.compress(pixels, TILE_COMPRESSION_LEVEL), dtype=np.uint8)
+    else:
+        wire = pixels.reshape(-1).view(np.uint8)
+    return (tile_index, shape, dtype, wire.size), wire
+
+
+def unpack_tile(header, wire, codec):
+    if len(header) > 4:
+        return header[0], attach_shared(header)
+    tile_index, shape, dtype, _ = header
+    if codec == "zlib":
+        wire = np.frombuffer(zlib.decompress(wire), dtype=np.uint8)
+    if not isinstance(shape, list):
+        return tile_index, wire.view(np.dtype(dtype)).reshape(shape)
+
+    arrays, offset = [], 0
+    for array_shape, array_dtype in zip(shape, dtype):
+        length = int(np.prod(array_shape)) * np.dtype(array_dtype).itemsize
+        arrays.append(wire[offset:offset + length].view(np.dtype(array_dtype)).reshape(array_shape))
+        offset += length
+    return tile_index, arrays
+
+
+def send_tile(tile_index, pixels, dest, tag, data_tag, codec):
+    # A small pickled header tells the receiver how much to preallocate
+    header, wire = pack_tile(tile_index, pixels, codec, dest)
+    comm.send(header, dest=dest, tag=tag)
+    if wire is not None:
+        comm.Send(wire, dest=dest, tag=data_tag)
+
+
+def recv_tile(source, tag, data_tag, codec, status=None):
+    # Returns None when the sender signals there are no more tiles
+    status = status if status is not None else MPI.Status()
+    header = comm.recv(source=source, tag=tag, status=status)
+    if header is None:
+        return None
+    return recv_tile_data(header, status.Get_source(), data_tag, codec)
+
 
-    # Encode the processed image to bytes
-    _, buffer = cv2.imencode('.jpg', processed_img)
-    return buffer.tobytes()
+def recv_tile_data(header, source, data_tag, codec):
+    if len(header) > 4:
+        return unpack_tile(header, None, codec)
+    wire = np.empty(header[3], dtype=np.uint8)
+    comm.Recv(wire, source=source, tag=data_tag)
+    return unpack_tile(header, wire, codec)
 
 
 def check_hosts_alive(hosts):
@@ -103,81 +563,942 @@ def launch_mpi_processes(alive_hosts, script_path):
         execute_try_py()
 
 
-def handle_client(client_socket):
+class PendingJob:
+    def __init__(self, job, img):
+        self.job = job
+        self.img = img
+        self.tiles = []
+        self.queue = deque()
+        self.processed_tiles = []
+        self.remaining = 0
+        self.result = None
+        self.on_finish = None
+        self.failed = False
+
+    def finish(self, result):
+        self.result = result
+        if self.on_finish is not None:
+            self.on_finish(result)
+
+    def fail(self):
+        # Reported once; results of tiles still out are drained and dropped
+        if not self.failed:
+            self.failed = True
+            self.finish(None)
+
+
+def distribute_point_to_point(img, job):
+    tiles = split_into_tiles(img, job["halo"], job["tile_size"])
+    job = with_cores(job, tiles)
+    num_tiles = len(tiles)
+    logging.debug(f"Rank 0: Split {img.shape[1]}x{img.shape[0]} image into {num_tiles} tiles")
+
+    assignments = partition_tiles(tiles, size - 1)
+    logging.info(f"Master node is distributing {num_tiles} tiles to {size - 1} slave nodes "
+                 f"({PARTITION_STRATEGY} partitioning, {job['transport']} transport).")
+
+    processed_tiles = [None] * num_tiles
+    failed_nodes = []
+
+    for i in range(1, size):
+        assigned = assignments[i - 1]
+        try:
+            comm.send(job, dest=i, tag=5)
+            comm.send(len(assigned), dest=i, tag=1)
+            for tile_index in assigned:
+                send_tile(tile_index, tiles[tile_index].pixels, i, 2, TILE_DATA_TAG, job["transport"])
+                comm.recv(source=i, tag=4)
+        except MPI.Exception as e:
+            logging.error(f"Failed to send/receive data to/from slave {i}: {e}")
+            failed_nodes.append(i)
+            execute_try_py()
+            return None
+
+    status = MPI.Status()
+    for _ in range(num_tiles):
+        try:
+            tile_index, processed_tile = recv_tile(MPI.ANY_SOURCE, 3, RESULT_DATA_TAG, job["transport"], status)
+            processed_tiles[tile_index] = processed_tile
+        except MPI.Exception as e:
+            logging.error(f"Failed to receive processed tile from slave {status.Get_source()}: {e}")
+            failed_nodes.append(status.Get_source())
+            execute_try_py()
+            return None
+
+    return collect_tiles(img.shape, tiles, processed_tiles, job)
+
+
+def serve_point_to_point(job):
+    num_tiles = comm.recv(source=0, tag=1)
+    logging.info(f"Slave node {rank} received {num_tiles} tiles to process.")
+
+    # Take the whole assignment first so the master never blocks
+    # sending a tile while this slave is sending a result back
+    received_tiles = []
+    for _ in range(num_tiles):
+        received_tiles.append(recv_tile(0, 2, TILE_DATA_TAG, job["transport"]))
+        comm.send(True, dest=0, tag=4)
+
+    for tile_index, pixels in received_tiles:
+        processed_tile = apply_tile(tile_index, pixels, job)
+        send_tile(tile_index, processed_tile, 0, 3, RESULT_DATA_TAG, job["transport"])
+
+
+def distribute_pipelined(img, job):
+    tiles = split_into_tiles(img, job["halo"], job["tile_size"])
+    job = with_cores(job, tiles)
+    num_tiles = len(tiles)
+    assignments = partition_tiles(tiles, size - 1)
+    window = job["window"]
+    logging.info(f"Master node is pipelining {num_tiles} tiles to {size - 1} slave nodes "
+                 f"with a window of {window} tiles per slave.")
+
+    queues = {i: deque(assignments[i - 1]) for i in range(1, size)}
+    # Buffers stay referenced until their Isend completes
+    pending_sends = []
+
+    def post_next_tile(i):
+        tile_index = queues[i].popleft()
+        header, wire = pack_tile(tile_index, tiles[tile_index].pixels, job["transport"], i)
+        pending_sends.append((comm.isend(header, dest=i, tag=2), wire))
+        if wire is not None:
+            pending_sends.append((comm.Isend(wire, dest=i, tag=TILE_DATA_TAG), wire))
+
+    processed_tiles = [None] * num_tiles
+    status = MPI.Status()
+    try:
+        for i in range(1, size):
+            comm.send(job, dest=i, tag=5)
+            comm.send(len(queues[i]), dest=i, tag=1)
+            for _ in range(min(window, len(queues[i]))):
+                post_next_tile(i)
+
+        for _ in range(num_tiles):
+            tile_index, processed_tile = recv_tile(MPI.ANY_SOURCE, 3, RESULT_DATA_TAG, job["transport"], status)
+            processed_tiles[tile_index] = processed_tile
+            source = status.Get_source()
+            if queues[source]:
+                post_next_tile(source)
+
+        MPI.Request.Waitall([request for request, _ in pending_sends])
+    except MPI.Exception as e:
+        logging.error(f"Pipelined distribution failed at slave {status.Get_source()}: {e}")
+        execute_try_py()
+        return None
+
+    return collect_tiles(img.shape, tiles, processed_tiles, job)
+
+
+def serve_pipelined(job):
+    num_tiles = comm.recv(source=0, tag=1)
+    window = job["window"]
+    logging.info(f"Slave node {rank} received {num_tiles} tiles to process.")
+
+    incoming = deque()
+    pending_sends = []
+    received = 0
+    for _ in range(num_tiles):
+        # Post receives for tiles whose header already arrived so their pixels
+        # land while this slave computes; only block when nothing is queued
+        while received < num_tiles and len(incoming) < window and (
+                not incoming or comm.iprobe(source=0, tag=2)):
+            header = comm.recv(source=0, tag=2)
+            if len(header) > 4:
+                # Already in shared memory
+                incoming.append((header, None, MPI.REQUEST_NULL))
+                received += 1
+                continue
+            wire = np.empty(header[3], dtype=np.uint8)
+            incoming.append((header, wire, comm.Irecv(wire, source=0, tag=TILE_DATA_TAG)))
+            received += 1
+
+        header, wire, request = incoming.popleft()
+        request.Wait()
+        tile_index, pixels = unpack_tile(header, wire, job["transport"])
+        processed = apply_tile(tile_index, pixels, job)
+        header, wire = pack_tile(tile_index, processed, job["transport"])
+        pending_sends.append((comm.isend(header, dest=0, tag=3), wire))
+        pending_sends.append((comm.Isend(wire, dest=0, tag=RESULT_DATA_TAG), wire))
+        pending_sends = [(r, buffer) for r, buffer in pending_sends if not r.Test()]
+
+    MPI.Request.Waitall([request for request, _ in pending_sends])
+
+
+def distribute_dynamic(img, job):
+    tiles = split_into_tiles(img, job["halo"], job["tile_size"], job["tile_size"] // TAIL_TILE_DIVISOR)
+    job = with_cores(job, tiles)
+    num_tiles = len(tiles)
+    logging.info(f"Master node is scheduling {num_tiles} tiles on demand across {size - 1} slave nodes.")
+
+    queue = deque(tiles)
+    job_tile_counts = {i: 0 for i in range(1, size)}
+    processed_tiles = [None] * num_tiles
+    status = MPI.Status()
+
+    def hand_out_next_tile(i):
+        # A None header tells the slave the job has no more tiles
+        if queue:
+            tile = queue.popleft()
+            send_tile(tile.index, tile.pixels, i, 2, TILE_DATA_TAG, job["transport"])
+        else:
+            comm.send(None, dest=i, tag=2)
+
+    try:
+        for i in range(1, size):
+            comm.send(job, dest=i, tag=5)
+            hand_out_next_tile(i)
+
+        for _ in range(num_tiles):
+            tile_index, processed_tile = recv_tile(MPI.ANY_SOURCE, 3, RESULT_DATA_TAG, job["transport"], status)
+            processed_tiles[tile_index] = processed_tile
+            source = status.Get_source()
+            job_tile_counts[source] += 1
+            hand_out_next_tile(source)
+    except MPI.Exception as e:
+        logging.error(f"Dynamic scheduling failed at slave {status.Get_source()}: {e}")
+        execute_try_py()
+        return None
+
+    for i, count in job_tile_counts.items():
+        worker_tile_counts[i] = worker_tile_counts.get(i, 0) + count
+    logging.info(f"Tiles per slave for this job: {job_tile_counts}; since start: {worker_tile_counts}")
+
+    return collect_tiles(img.shape, tiles, processed_tiles, job)
+
+
+def serve_dynamic(job):
+    processed_count = 0
+    while True:
+        received = recv_tile(0, 2, TILE_DATA_TAG, job["transport"])
+        if received is None:
+            break
+        tile_index, pixels = received
+
+        processed_tile = apply_tile(tile_index, pixels, job)
+        send_tile(tile_index, processed_tile, 0, 3, RESULT_DATA_TAG, job["transport"])
+        processed_count += 1
+    logging.info(f"Slave node {rank} processed {processed_count} tiles on demand.")
+
+
+def serve_shared(job):
+    tile_index, pixels = recv_tile(0, 2, TILE_DATA_TAG, job["transport"])
+    processed_tile = apply_tile(tile_index, pixels, job)
+    send_tile(tile_index, processed_tile, 0, 3, RESULT_DATA_TAG, job["transport"])
+
+
+def split_into_bands(height, num_workers, halo):
+    # One row band per worker as ((y0, y1), (padded_y0, padded_y1))
+    per_worker, remainder = divmod(height, num_workers)
+    bands = []
+    y0 = 0
+    for worker in range(num_workers):
+        y1 = y0 + per_worker + (1 if worker < remainder else 0)
+        padded = (max(y0 - halo, 0), min(y1 + halo, height)) if y1 > y0 else (y0, y0)
+        bands.append(((y0, y1), padded))
+        y0 = y1
+    return bands
+
+
+def distribute_collective(img, job):
+    halo = job["halo"]
+    height = img.shape[0]
+    row_bytes = img[0].nbytes
+    bands = split_into_bands(height, size - 1, halo)
+    logging.info(f"Master node is scattering {height} rows to {size - 1} slave nodes in one collective.")
+
+    try:
+        for i in range(1, size):
+            comm.send(job, dest=i, tag=5)
+
+        # Rank 0 scatters and gathers but keeps an empty band for itself
+        layouts = [None] + [((padded[1] - padded[0],) + img.shape[1:], img.dtype.str, y0 - padded[0], y1 - y0)
+                            for (y0, y1), padded in bands]
+        comm.scatter(layouts, root=0)
+
+        counts = [0] + [(padded[1] - padded[0]) * row_bytes for _, padded in bands]
+        if halo:
+            # Scatterv must not read any root location twice, so overlapping
+            # halos are packed into their own buffer
+            send_buffer = np.concatenate([img[padded[0]:padded[1]].ravel() for _, padded in bands])
+            displacements = [0] + [int(d) for d in np.cumsum([0] + counts[1:-1])]
+        else:
+            send_buffer = img
+            displacements = [0] + [padded[0] * row_bytes for _, padded in bands]
+        comm.Scatterv([send_buffer, counts, displacements, MPI.BYTE], np.empty(0, dtype=np.uint8), root=0)
+
+        results = comm.gather(None, root=0)
+        if job.get("measure"):
+            # Each slave sent the statistic of its band instead of a shape
+            return [statistic for statistic in results[1:] if statistic is not None]
+        shape, dtype = next((shape, dtype) for shape, dtype in results[1:] if shape[0])
+        output = np.empty((height,) + tuple(shape[1:]), dtype=np.dtype(dtype))
+        output_row_bytes = output[0].nbytes
+        counts = [0] + [(y1 - y0) * output_row_bytes for (y0, y1), _ in bands]
+        displacements = [0] + [y0 * output_row_bytes for (y0, _), _ in bands]
+        comm.Gatherv(np.empty(0, dtype=np.uint8), [output, counts, displacements, MPI.BYTE], root=0)
+    except MPI.Exception as e:
+        logging.error(f"Collective scatter/gather failed: {e}")
+        execute_try_py()
+        return None
+
+    return output
+
+
+def serve_collective(job):
+    shape, dtype, top, rows = comm.scatter(None, root=0)
+    band = np.empty(shape, dtype=np.dtype(dtype))
+    comm.Scatterv(None, band, root=0)
+    logging.info(f"Slave node {rank} received a band of {rows} rows to process.")
+
+    if job.get("measure"):
+        comm.gather(apply_job(band, job, (top, top + rows, 0, band.shape[1])) if rows else None, root=0)
+        return
+    if rows:
+        processed = apply_job(band, job)
+        processed = np.ascontiguousarray(processed[top:top + rows])
+    else:
+        processed = np.empty((0,), dtype=np.uint8)
+    comm.gather((processed.shape, processed.dtype.str), root=0)
+    comm.Gatherv(processed, None, root=0)
+
+
+async def submit_job(job, img):
+    # Resolves on the event loop once the backend has processed every tile
+    return await backend.submit(job, img)
+
+
+async def run_job(job, img):
+    # Co-located slaves read the image from shared memory for the whole job,
+    # measuring passes included
+    segment = None
+    if backend.shares_memory():
+        img, segment = share_image(img)
+    try:
+        return await run_measured_job(job, img)
+    finally:
+        if segment is not None:
+            release_image(segment)
+
+
+async def run_measured_job(job, img):
+    # Steps that need a whole-image statistic cannot be run tile by tile
+    # straight away. For each one a measuring job first has every tile report
+    # the statistic over its core; the combined value then becomes a
+    # parameter of the step. Untiled jobs leave the slave to measure the
+    # whole image itself.
+    if job["halo"] is not None and not job["whole_image"]:
+        job = dict(job, outputs=copy.deepcopy(job["outputs"]))
+        # Outputs measuring the same statistic of the same input share one measuring job
+        measured = {}
+        for steps in job["outputs"]:
+            pipeline = operations.compile_pipeline(steps)
+            while pipeline.unresolved() is not None:
+                index = pipeline.unresolved()
+                reduction = pipeline.steps[index][0].reduction
+                key = (repr(steps[:index]), repr(steps[index][1]), reduction)
+                if key not in measured:
+                    measure_pipeline = operations.compile_pipeline(steps[:index + 1])
+                    measure_job = dict(job, outputs=[measure_pipeline.spec], halo=measure_pipeline.halo,
+                                       measure=True, operation=f"{measure_pipeline.name} (measure)")
+                    statistics = await submit_job(measure_job, img)
+                    if statistics is None:
+                        return None
+                    measured[key] = reduction.combine(statistics)
+                steps[index][1][reduction.param] = measured[key]
+                pipeline = operations.compile_pipeline(steps)
+
+    result = await submit_job(job, img)
+    if result is None:
+        return None
+    pipelines = operations.compile_outputs(job["outputs"]).pipelines
+    if len(pipelines) == 1:
+        return pipelines[0].finish(result)
+    return [pipeline.finish(output) for pipeline, output in zip(pipelines, result)]
+
+
+def find_shared_memory_peers():
+    # Slaves on rank 0's host can map its shared memory segments
+    host = MPI.Get_processor_name()
+    for i in range(1, size):
+        if comm.recv(source=i, tag=HOST_TAG) == host and SHARED_MEMORY:
+            shared_memory_peers.add(i)
+    logging.info(f"Slaves sharing memory with the master: {sorted(shared_memory_peers) or 'none'}")
+
+
+def run_dispatcher():
+    # The only thread on rank 0 that talks MPI. Shared jobs are interleaved
+    # round-robin, one tile per idle slave; jobs for the other engines wait
+    # until the pool drains and then get every slave to themselves.
+    exclusive_engines = {
+        "p2p": distribute_point_to_point,
+        "collective": distribute_collective,
+        "pipelined": distribute_pipelined,
+        "dynamic": distribute_dynamic,
+    }
+    find_shared_memory_peers()
+    idle_workers = deque(range(1, size))
+    active_jobs = deque()
+    exclusive_jobs = deque()
+    in_flight = {}
+    status = MPI.Status()
+
+    # A failing job only fails itself. The slaves holding its tiles keep
+    # their place in in_flight and their results are drained as they come.
+    def drop(pending, e):
+        logging.error(f"Dispatcher failed {pending.job['operation']}: {e}")
+        if pending in active_jobs:
+            active_jobs.remove(pending)
+        pending.fail()
+
+    def admit(pending):
+        if pending.job["engine"] in exclusive_engines:
+            exclusive_jobs.append(pending)
+            return
+        try:
+            halo = None if pending.job["whole_image"] else pending.job["halo"]
+            pending.tiles = split_into_tiles(pending.img, halo, pending.job["tile_size"],
+                                             pending.job["tile_size"] // TAIL_TILE_DIVISOR)
+            if not pending.tiles:
+                raise ValueError("the image split into no tiles")
+            pending.job = with_cores(pending.job, pending.tiles)
+        except Exception as e:
+            drop(pending, e)
+            return
+        pending.queue = deque(pending.tiles)
+        pending.processed_tiles = [None] * len(pending.tiles)
+        pending.remaining = len(pending.tiles)
+        active_jobs.append(pending)
+        logging.info(f"Queued {pending.remaining} tiles for {pending.job['operation']}; "
+                     f"{len(active_jobs)} jobs sharing the slave pool.")
+
+    while True:
+        try:
+            if not active_jobs and not exclusive_jobs and not in_flight:
+                admit(job_queue.get())
+            while not job_queue.empty():
+                admit(job_queue.get_nowait())
+
+            if exclusive_jobs and not in_flight:
+                pending = exclusive_jobs.popleft()
+                try:
+                    result = exclusive_engines[pending.job["engine"]](pending.img, pending.job)
+                except Exception as e:
+                    logging.error(f"Dispatcher failed {pending.job['operation']}: {e}")
+                    result = None
+                pending.finish(result)
+                continue
+
+            # Hold back new tiles while an exclusive job waits for the pool to drain
+            while idle_workers and active_jobs and not exclusive_jobs:
+                worker = idle_workers.popleft()
+                pending = active_jobs[0]
+                try:
+                    tile = pending.queue.popleft()
+                    comm.send(pending.job, dest=worker, tag=5)
+                    send_tile(tile.index, tile.pixels, worker, 2, TILE_DATA_TAG, pending.job["transport"])
+                except Exception as e:
+                    idle_workers.appendleft(worker)
+                    drop(pending, e)
+                    continue
+                in_flight[worker] = pending
+                if pending.queue:
+                    active_jobs.rotate(-1)
+                else:
+                    active_jobs.popleft()
+
+            if not in_flight:
+                continue
+            if not comm.iprobe(source=MPI.ANY_SOURCE, tag=3):
+                try:
+                    admit(job_queue.get(timeout=DISPATCH_POLL_INTERVAL))
+                except queue.Empty:
+                    pass
+                continue
+
+            # The header identifies the slave, and so the job and its codec
+            header = comm.recv(source=MPI.ANY_SOURCE, tag=3, status=status)
+            worker = status.Get_source()
+            pending = in_flight.pop(worker)
+            idle_workers.append(worker)
+            try:
+                tile_index, processed_tile = recv_tile_data(header, worker, RESULT_DATA_TAG,
+                                                            pending.job["transport"])
+            except Exception as e:
+                drop(pending, e)
+                continue
+            if pending.failed:
+                continue
+            pending.processed_tiles[tile_index] = processed_tile
+            pending.remaining -= 1
+            if pending.remaining == 0:
+                try:
+                    result = collect_tiles(pending.img.shape, pending.tiles, pending.processed_tiles, pending.job)
+                except Exception as e:
+                    drop(pending, e)
+                    continue
+                pending.finish(result)
+        except Exception as e:
+            # Not tied to a job; the pool state is left as it is
+            logging.exception(f"Dispatcher error: {e}")
+            execute_try_py()
+
+
+class MPIBackend:
+    # Tiles go to the slave ranks through the dispatcher thread
+    name = "mpi"
+
+    def start(self):
+        if MPI.Query_thread() < MPI.THREAD_SERIALIZED:
+            logging.warning("MPI was not initialised with thread support; the dispatcher thread may misbehave.")
+        threading.Thread(target=run_dispatcher, daemon=True).start()
+
+    def shares_memory(self):
+        return bool(shared_memory_peers)
+
+    async def submit(self, job, img):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = PendingJob(job, img)
+        pending.on_finish = lambda result: loop.call_soon_threadsafe(future.set_result, result)
+        job_queue.put(pending)
+        return await future
+
+
+def start_local_worker():
+    global local_worker
+    local_worker = True
+    # One OpenCV thread per worker process, as the processes already fill the cores
+    cv2.setNumThreads(1)
+
+
+def detach(result, pixels):
+    # An operation may hand back its input or a view of it; such results
+    # are copied so the tile's segment can close before they are pickled
+    if isinstance(result, list):
+        return [detach(array, pixels) for array in result]
+    if isinstance(result, np.ndarray) and np.may_share_memory(result, pixels):
+        return result.copy()
+    return result
+
+
+def run_local_tile(job, header, wire):
+    # Runs in a local backend worker process
+    tile_index, pixels = unpack_tile(header, wire, "raw")
+    result = detach(apply_tile(tile_index, pixels, job), pixels)
+    del pixels
+    close_segments(attached_segments)
+    return tile_index, result
+
+
+class LocalBackend:
+    # Tiles go to a pool of worker processes on this machine. Each worker
+    # maps the job's image from shared memory, so only tile locations and
+    # results cross process boundaries. Tiles are queued on the pool as they
+    # are split, so concurrent jobs share the workers in arrival order.
+    name = "local"
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None
+
+    def start(self):
+        # Forked workers need no re-import of this script, which would
+        # initialise MPI in each of them. Forking starts every worker on the
+        # first submission, so that happens here, before the event loop and
+        # its executor threads exist. A pool replaced after a worker died is
+        # forked from the running server. The resource tracker is started
+        # first so the workers inherit it rather than each starting their own,
+        # which would remove the job's segments if that worker died.
+        resource_tracker.ensure_running()
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("fork"),
+                                        initializer=start_local_worker)
+        self.pool.submit(int).result()
+        logging.info(f"Processing tiles locally on {self.workers} worker processes.")
+
+    def shares_memory(self):
+        return SHARED_MEMORY
+
+    async def submit(self, job, img):
+        loop = asyncio.get_running_loop()
+        if job["engine"] != "shared":
+            logging.info(f"The local backend has no {job['engine']} engine; queuing {job['operation']} on the pool.")
+        halo = None if job["whole_image"] else job["halo"]
+        tiles = split_into_tiles(img, halo, job["tile_size"])
+        job = with_cores(job, tiles)
+
+        futures = []
+        try:
+            for tile in tiles:
+                header, wire = shared_tile_header(tile.index, tile.pixels), None
+                if header is None:
+                    header, wire = pack_tile(tile.index, tile.pixels, "raw")
+                futures.append(loop.run_in_executor(self.pool, run_local_tile, job, header, wire))
+            results = await asyncio.gather(*futures)
+        except BrokenProcessPool as e:
+            # A worker died; the pool accepts no more work, so later jobs get a new one
+            logging.error(f"Local worker pool broke on {job['operation']}: {e}; restarting it.")
+            self.pool.shutdown(wait=False)
+            self.start()
+            return None
+        except Exception as e:
+            logging.error(f"Local worker failed on {job['operation']}: {e}")
+            return None
+
+        processed_tiles = [None] * len(tiles)
+        for tile_index, processed_tile in results:
+            processed_tiles[tile_index] = processed_tile
+        return collect_tiles(img.shape, tiles, processed_tiles, job)
+
+
+# Chosen by start_server; jobs submitted before then go to the MPI dispatcher
+backend = MPIBackend()
+
+
+def build_job(operation, options, whole_image=False, outputs=None):
+    # A "pipeline" parameter (a list of operation names or [name, params]
+    # pairs, or an "a -> b -> c" string) runs several steps per tile in one
+    # pass; otherwise the job is just the header's operation. An "outputs"
+    # parameter lists several such pipelines to run over the same tiles,
+    # sharing whatever intermediates they have in common.
+    if outputs is None:
+        outputs = options.get("outputs") or [options.get("pipeline") or [operation]]
+    output_set = operations.compile_outputs(outputs, options)
+    job = {
+        "operation": output_set.name,
+        "outputs": output_set.spec,
+        "halo": output_set.halo,
+        "tile_size": int(options.get("tile_size") or output_set.tile_size or TILE_SIZE),
+        "engine": options.get("engine", DISTRIBUTION_ENGINE),
+        "transport": options.get("transport", TRANSPORT),
+        "window": int(options.get("window", PIPELINE_WINDOW)),
+        # Batch items go to one slave each instead of being tiled
+        "whole_image": whole_image,
+    }
+    if job["tile_size"] < MIN_SUB_TILE_SIZE:
+        raise ValueError(f"tile_size must be at least {MIN_SUB_TILE_SIZE}, got {job['tile_size']}")
+    if job["window"] < 1:
+        raise ValueError(f"window must be at least 1, got {job['window']}")
+    if job["engine"] not in DISTRIBUTION_ENGINES:
+        raise ValueError(f"Unknown engine: {job['engine']}; expected one of {', '.join(DISTRIBUTION_ENGINES)}")
+    if whole_image:
+        job["engine"] = "shared"
+    if job["engine"] == "collective" and output_set.halo is None:
+        logging.info(f"{output_set.name} needs the whole image; using point-to-point instead of collective.")
+        job["engine"] = "p2p"
+    if job["engine"] == "collective" and len(job["outputs"]) > 1:
+        logging.info("Bands carry a single result; using point-to-point for a job with several outputs.")
+        job["engine"] = "p2p"
+    return job
+
+
+def encode_result(img, operation, options):
+    # Returns the response payload and the parameters describing it
+    output_format = options.get("format", DEFAULT_OUTPUT_FORMATS.get(operation, "jpeg"))
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+
+    if output_format == "raw":
+        pixels = np.ascontiguousarray(img)
+        return memoryview(pixels.reshape(-1).view(np.uint8)), {
+            "format": "raw", "shape": list(pixels.shape), "dtype": pixels.dtype.str}
+
+    encode_params = []
+    if output_format == "jpeg" and "quality" in options:
+        encode_params = [cv2.IMWRITE_JPEG_QUALITY, int(options["quality"])]
+    elif output_format == "webp" and "quality" in options:
+        encode_params = [cv2.IMWRITE_WEBP_QUALITY, int(options["quality"])]
+    elif output_format == "png" and "compression" in options:
+        encode_params = [cv2.IMWRITE_PNG_COMPRESSION, int(options["compression"])]
+
+    start = time.time()
+    _, buffer = cv2.imencode(OUTPUT_FORMATS[output_format], img, encode_params)
+    logging.debug(f"Encoded {output_format} result ({buffer.size} bytes) in {time.time() - start:.3f}s")
+    return memoryview(buffer.reshape(-1)), {"format": output_format}
+
+
+def encode_outputs(results, job, options):
+    # Each output gets the default format of the last operation in its pipeline
+    return [encode_result(img, steps[-1][0], options) for img, steps in zip(results, job["outputs"])]
+
+
+def save_result(filename, data):
+    with open(filename, "wb") as f:
+        f.write(data)
+
+
+def caching(options):
+    return cache is not None and options.get("cache", True)
+
+
+def result_cache_version():
+    # Cached results stay valid only while the code that computed them and
+    # the defaults it applied are unchanged, so both go into every key
+    with open(operations.__file__, "rb") as f:
+        code = f.read()
+    with open(os.path.abspath(__file__), "rb") as f:
+        code += f.read()
+    defaults = repr((DECODE_FAST_PATHS, GRAYSCALE_DECODE, sorted(DEFAULT_OUTPUT_FORMATS.items()), cv2.__version__))
+    return result_cache.content_digest(code + defaults.encode())
+
+
+def result_key(digest, operation, options):
+    return result_cache.cache_key(digest, operation, options, CACHE_IGNORED_PARAMS, cache.version)
+
+
+def lookup_result(key):
+    # Runs on an executor thread; disk hits read the cached file
+    entry = cache.get(key)
+    stats = cache.stats()
+    if (stats["memory_hits"] + stats["disk_hits"] + stats["misses"]) % CACHE_REPORT_INTERVAL == 0:
+        logging.info(f"Result cache: {stats}")
+    if entry is not None:
+        for _, result_params in entry:
+            result_params["cached"] = True
+    return entry
+
+
+async def cached_result(key, compute):
+    # Returns what compute() encodes, or the cached entry under key. A
+    # request arriving while an identical one is still running waits for
+    # that one's result instead of running the job again.
+    loop = asyncio.get_running_loop()
+    pending = pending_results.get(key)
+    if pending is not None:
+        entry = await asyncio.shield(pending)
+        if entry is not None:
+            return [(data, dict(result_params, cached=True)) for data, result_params in entry]
+        return await compute()  # The first request failed; fail with its own error
+
+    pending = pending_results[key] = loop.create_future()
+    entry = None
+    try:
+        entry = await loop.run_in_executor(None, lookup_result, key)
+        if entry is None:
+            entry = await compute()
+            if entry is not None:
+                await loop.run_in_executor(None, cache.put, key, entry)
+        return entry
+    finally:
+        # Waiters get their own params, as this request goes on to annotate its own
+        del pending_results[key]
+        pending.set_result(None if entry is None else [(data, dict(result_params))
+                                                        for data, result_params in entry])
+
+
+async def send_response(writer, kind, operation, request_id, params, payload, status=protocol.STATUS_OK):
+    # Frames for concurrent requests on one connection go out one at a time
+    async with write_locks[writer]:
+        await protocol.write_message(writer, kind, operation, request_id, params, payload, status)
+
+
+async def handle_request(request, writer):
+    loop = asyncio.get_running_loop()
+    operation, options = request.operation, request.params
+    job = build_job(operation, options)
+
+    async def compute():
+        # Codec work runs off the event loop so other connections keep flowing
+        img = await loop.run_in_executor(None, decode_image, request.payload, job, options)
+        if img is None:
+            raise ValueError("Received data could not be decoded as an image")
+
+        processed_img = await run_job(job, img)
+        if processed_img is None:
+            return None
+        results = processed_img if len(job["outputs"]) > 1 else [processed_img]
+        return await loop.run_in_executor(None, encode_outputs, results, job, options)
+
+    if caching(options):
+        digest = await loop.run_in_executor(None, result_cache.content_digest, request.payload)
+        encoded = await cached_result(result_key(digest, operation, options), compute)
+    else:
+        encoded = await compute()
+    if encoded is None:
+        await send_response(writer, protocol.MSG_RESPONSE, operation, request.request_id,
+                            {"error": "Processing failed"}, b"", protocol.STATUS_ERROR)
+        return
+
+    if len(encoded) > 1:
+        # Outputs travel back to back in one payload, described in order by
+        # the "outputs" parameter
+        for output, (data, result_params) in enumerate(encoded):
+            result_params["length"] = len(data)
+            if options.get("save"):
+                extension = OUTPUT_FORMATS[result_params["format"]]
+                result_params["saved_as"] = os.path.join(
+                    RESULTS_DIR, f"processed_image_{request.request_id.hex()}+{operation}_{output}{extension}")
+                await loop.run_in_executor(None, save_result, result_params["saved_as"], data)
+        await send_response(writer, protocol.MSG_RESPONSE, operation, request.request_id,
+                            {"outputs": [result_params for _, result_params in encoded]},
+                            b"".join(data for data, _ in encoded))
+        return
+
+    processed_img_bytes, result_params = encoded[0]
+    if not options.get("save"):
+        await send_response(writer, protocol.MSG_RESPONSE, operation, request.request_id,
+                            result_params, processed_img_bytes)
+        return
+
+    # The request id keeps names unique when jobs finish in the same second
+    extension = OUTPUT_FORMATS[result_params["format"]]
+    processed_filename = os.path.join(RESULTS_DIR,
+                                      f"processed_image_{request.request_id.hex()}+{operation}{extension}")
+    await loop.run_in_executor(None, save_result, processed_filename, processed_img_bytes)
+    result_params["saved_as"] = processed_filename
+
+    # The payload goes straight from the saved file. The lock is held until
+    # sendfile is done, as the transport refuses writes while it runs.
+    async with write_locks[writer]:
+        writer.write(protocol.pack_header(protocol.MSG_RESPONSE, operation, request.request_id,
+                                          result_params, len(processed_img_bytes)))
+        await writer.drain()
+        with open(processed_filename, "rb") as f:
+            await loop.sendfile(writer.transport, f)
+
+
+async def handle_batch(request, writer):
+    loop = asyncio.get_running_loop()
+    options = dict(request.params)
+    operation_names = options.pop("operations", None) or [request.operation]
+    lengths = options.pop("items", None)
+    if not isinstance(lengths, list):
+        raise protocol.ProtocolError("A batch request needs an \"items\" list of image lengths")
+    if sum(lengths) != len(request.payload):
+        raise protocol.ProtocolError("Batch item lengths do not add up to the payload length")
+    unknown = [operation for operation in operation_names if operation not in protocol.OPERATION_IDS]
+    if unknown:
+        raise protocol.ProtocolError(f"Unknown operations: {unknown}")
+
+    logging.info(f"Batch of {len(lengths)} images x {len(operation_names)} operations received.")
+    payload = memoryview(request.payload)
+    in_flight = asyncio.Semaphore(BATCH_MAX_IN_FLIGHT)
+    failed = 0
+
+    async def respond_error(index, operation, message):
+        nonlocal failed
+        failed += 1
+        await send_response(writer, protocol.MSG_RESPONSE, operation, request.request_id,
+                            {"item": index, "error": message}, b"", protocol.STATUS_ERROR)
+
+    # One job per image runs every operation on the same slave so they
+    # share their grayscale and gradient intermediates
+    job = build_job(operation_names[0], options, whole_image=True,
+                    outputs=[[operation] for operation in operation_names])
+
+    def lookup_item(data):
+        # Cache keys match those of single requests for the same image and
+        # operation. Returns the keys, and the cached results when every
+        # operation has one.
+        digest = result_cache.content_digest(data)
+        keys = [result_key(digest, operation, options) for operation in operation_names]
+        encoded = []
+        for key in keys:
+            entry = lookup_result(key)
+            if entry is None:
+                return keys, None
+            encoded.extend(entry)
+        return keys, encoded
+
+    def store_item(keys, encoded):
+        for key, output in zip(keys, encoded):
+            cache.put(key, [output])
+
+    async def run_item(index, data):
+        async with in_flight:
+            keys = encoded = None
+            if caching(options):
+                keys, encoded = await loop.run_in_executor(None, lookup_item, data)
+            if encoded is None:
+                img = await loop.run_in_executor(None, decode_image, data, job, options)
+                if img is None:
+                    for operation in operation_names:
+                        await respond_error(index, operation, "Image could not be decoded")
+                    return
+
+                processed_img = await run_job(job, img)
+                if processed_img is None:
+                    for operation in operation_names:
+                        await respond_error(index, operation, "Processing failed")
+                    return
+
+                results = processed_img if len(operation_names) > 1 else [processed_img]
+                encoded = await loop.run_in_executor(None, encode_outputs, results, job, options)
+                if keys is not None:
+                    await loop.run_in_executor(None, store_item, keys, encoded)
+
+            for operation, (result, result_params) in zip(operation_names, encoded):
+                result_params["item"] = index
+                await send_response(writer, protocol.MSG_RESPONSE, operation, request.request_id,
+                                    result_params, result)
+
+    offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+    await asyncio.gather(*(run_item(index, payload[offsets[index]:offsets[index + 1]])
+                           for index in range(len(lengths))))
+
+    summary = {"items": len(lengths), "results": len(lengths) * len(operation_names), "failed": failed}
+    logging.info(f"Batch finished: {summary}")
+    await send_response(writer, protocol.MSG_BATCH_DONE, operation_names[0], request.request_id, summary, b"")
+
+
+async def handle_frame(request, writer):
+    try:
+        if request.kind == protocol.MSG_REQUEST:
+            await handle_request(request, writer)
+        elif request.kind == protocol.MSG_BATCH_REQUEST:
+            await handle_batch(request, writer)
+        else:
+            raise protocol.ProtocolError(f"Expected a request, got message kind {request.kind}")
+    except (protocol.ProtocolError, ValueError, cv2.error) as e:
+        logging.error(f"Error handling client request: {e}")
+        await send_response(writer, protocol.MSG_RESPONSE, request.operation, request.request_id,
+                            {"error": str(e)}, b"", protocol.STATUS_ERROR)
+    except Exception as e:
+        # Anything else is a bug, but the client is still owed a response
+        logging.exception(f"Unexpected error handling client request: {e}")
+        await send_response(writer, protocol.MSG_RESPONSE, request.operation, request.request_id,
+                            {"error": f"Internal error: {type(e).__name__}: {e}"}, b"",
+                            protocol.STATUS_ERROR)
+
+
+async def handle_client(reader, writer):
+    # Requests on one connection are handled concurrently, so a client can
+    # pipeline several of them; responses carry the request id and may come
+    # back in any order
+    loop = asyncio.get_running_loop()
+    logging.info(f"Connection from {writer.get_extra_info('peername')}")
+    in_progress = set()
+    write_locks[writer] = asyncio.Lock()
     try:
-        image_data = b""
         while True:
-            chunk = client_socket.recv(4096)
-            if not chunk:
-                break
-            if b"IMAGE SENT" in chunk:
-                client_socket.send(b"IMAGE RECEIVED")
+            try:
+                request = await protocol.read_message(reader)
+            except asyncio.IncompleteReadError:
+                break  # Client closed the connection
+            except protocol.ProtocolError as e:
+                # The stream cannot be resynchronised after a bad header
+                logging.error(f"Closing connection after a bad frame: {e}")
                 break
-            image_data += chunk
-
-        operation = client_socket.recv(4096).decode()
-        client_socket.send(f"operation {operation} is sent".encode())
-        client_socket.recv(4096).decode()
-
-        if rank == 0:
-            logging.debug("Rank 0: Starting to process image data")
-            num_chunks = (len(image_data) + CHUNK_SIZE - 1) // CHUNK_SIZE
-            logging.debug(f"Rank 0: Calculated num_chunks = {num_chunks}")
-
-            for i in range(1, size):
-                comm.send(num_chunks, dest=i, tag=1)
-                comm.send(operation, dest=i, tag=5)
-
-            logging.info(f"Master node is distributing {num_chunks} chunks to {size - 1} slave nodes.")
-
-            processed_chunks = [None] * num_chunks
-            failed_nodes = []
-
-            for chunk_index in range(num_chunks):
-                start = chunk_index * CHUNK_SIZE
-                end = min(start + CHUNK_SIZE, len(image_data))
-                for i in range(1, size):
-                    try:
-                        comm.send(image_data[start:end], dest=i, tag=2)
-                        comm.recv(source=i, tag=4)
-                    except MPI.Exception as e:
-                        logging.error(f"Failed to send/receive data to/from slave {i}: {e}")
-                        failed_nodes.append(i)
-                        execute_try_py()
-                        return
-
-            for chunk_index in range(num_chunks):
-                for i in range(1, size):
-                    if i in failed_nodes:
-                        continue
-                    try:
-                        processed_chunk = comm.recv(source=i, tag=3)
-                        processed_chunks[chunk_index] = processed_chunk
-                    except MPI.Exception as e:
-                        logging.error(f"Failed to receive processed chunk from slave {i}: {e}")
-                        failed_nodes.append(i)
-                        execute_try_py()
-                        return
-
-            processed_img_bytes = b"".join([chunk for chunk in processed_chunks if chunk is not None])
-
-            timestamp = int(time.time())
-            processed_filename = f"processed_image_{timestamp}+{operation}.jpg"
-            with open(processed_filename, "wb") as f:
-                f.write(processed_img_bytes)
-
-            with open(processed_filename, "rb") as f:
-                img_data = f.read(4096)
-                while img_data:
-                    client_socket.send(img_data)
-                    img_data = f.read(4096)
-
-            message = b"DONE"
-            client_socket.send(message)
-            os.remove(processed_filename)
+            task = asyncio.create_task(handle_frame(request, writer))
+            in_progress.add(task)
+            task.add_done_callback(in_progress.discard)
+        await asyncio.gather(*in_progress)
     except Exception as e:
         logging.error(f"Error handling client: {e}")
-        execute_try_py()
+        await loop.run_in_executor(None, execute_try_py)
+    finally:
+        del write_locks[writer]
+        writer.close()
+
+
+async def serve_clients(host, port):
+    global cache
+    cache = result_cache.ResultCache(RESULT_CACHE_MEMORY_BYTES, RESULT_CACHE_DISK_BYTES, RESULT_CACHE_DIR,
+                                     result_cache_version())
+    logging.info(f"Result cache: {cache.stats()}")
+    server = await asyncio.start_server(handle_client, host, port, backlog=SERVER_BACKLOG)
+    logging.info(f"Server listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
 
 
 def execute_try_py():
@@ -188,14 +1509,35 @@ def execute_try_py():
         logging.error(f"Failed to execute try.py: {e}")
 
 
-def start_server(host, port):
+def start_server(host, port, backend_name=EXECUTION_BACKEND):
+    global backend
     if rank == 0:
         slave_hosts = ["slave1", "slave2", "slave3", "slave4", "slave11"]  # Replace with your slave hostnames
-        alive_hosts = check_hosts_alive(slave_hosts)
+        if backend_name == "auto" and size > 1:
+            backend_name = "mpi"
+        if backend_name == "local" and size > 1:
+            logging.warning(f"Local backend chosen; the other {size - 1} ranks stay idle.")
 
-        if not alive_hosts:
-            logging.error("No alive slave hosts found. Exiting.")
-            execute_try_py()
+        if backend_name == "mpi" and size > 1:
+            # Started by mpirun: the slave ranks are already waiting for jobs
+            backend = MPIBackend()
+            backend.start()
+            asyncio.run(serve_clients(host, port))
+            return
+
+        if backend_name != "local":
+            alive_hosts = check_hosts_alive(slave_hosts)
+            if not alive_hosts and backend_name == "mpi":
+                logging.error("No alive slave hosts found. Exiting.")
+                execute_try_py()
+                return
+            if not alive_hosts:
+                logging.warning("No alive slave hosts found; processing on this machine instead.")
+
+        if backend_name == "local" or not alive_hosts:
+            backend = LocalBackend(LOCAL_WORKERS)
+            backend.start()
+            asyncio.run(serve_clients(host, port))
             return
 
         script_path = os.path.abspath(__file__)
@@ -212,40 +1554,39 @@ def start_server(host, port):
 
         threading.Thread(target=monitor_slaves, daemon=True).start()
 
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind((host, port))
-        server_socket.listen(5)
-        logging.info(f"Server listening on {host}:{port}")
+        backend = MPIBackend()
+        backend.start()
 
-        while True:
-            try:
-                client_socket, client_address = server_socket.accept()
-                logging.info(f"Connection from {client_address}")
-                handle_client(client_socket)
-            except Exception as e:
-                logging.error(f"Error accepting client connection: {e}")
-                execute_try_py()
+        try:
+            asyncio.run(serve_clients(host, port))
+        except Exception as e:
+            logging.error(f"Front-end server stopped: {e}")
+            execute_try_py()
     else:
+        comm.send(MPI.Get_processor_name(), dest=0, tag=HOST_TAG)
+        start_worker_pool()
         while True:
             try:
                 logging.debug(f"Slave node {rank} waiting for instructions")
-                num_chunks = comm.recv(source=0, tag=1)
-                operation = comm.recv(source=0, tag=5)
-
-                logging.info(f"Slave node {rank} received {num_chunks} chunks to process.")
+                job = comm.recv(source=0, tag=5)
 
-                for chunk_index in range(num_chunks):
-                    try:
-                        image_chunk = comm.recv(source=0, tag=2)
-                        comm.send(True, dest=0, tag=4)
-
-                        processed_chunk = process_image(image_chunk, operation)
-
-                        comm.send(processed_chunk, dest=0, tag=3)
-                    except MPI.Exception as e:
-                        logging.error(f"Error processing chunk {chunk_index} in slave node {rank}: {e}")
-                        execute_try_py()
-                        return
+                if job["engine"] == "collective":
+                    serve_collective(job)
+                elif job["engine"] == "pipelined":
+                    serve_pipelined(job)
+                elif job["engine"] == "dynamic":
+                    serve_dynamic(job)
+                elif job["engine"] == "shared":
+                    serve_shared(job)
+                elif job["engine"] == "p2p":
+                    serve_point_to_point(job)
+                else:
+                    raise ValueError(f"Unknown engine: {job['engine']}")
+                close_segments(attached_segments)
+            except MPI.Exception as e:
+                logging.error(f"MPI error in slave node {rank}: {e}")
+                execute_try_py()
+                return
             except Exception as e:
                 logging.error(f"Error in slave node {rank}: {e}")
                 execute_try_py()
@@ -257,6 +1598,8 @@ if __name__ == "__main__":
 
     if not os.path.exists("uploads"):
         os.makedirs("uploads")
+    if not os.path.exists(RESULTS_DIR):
+        os.makedirs(RESULTS_DIR)
 
     logging.info(f"Environment Variables: {os.environ}")
 
@@ -266,8 +1609,13 @@ if __name__ == "__main__":
     except subprocess.CalledProcessError as e:
         logging.error("mpirun not found in PATH")
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["auto", "mpi", "local"], default=EXECUTION_BACKEND,
+                        help="where jobs run (default: %(default)s)")
+    args = parser.parse_args()
+
     try:
-        start_server(HOST, PORT)
+        start_server(HOST, PORT, args.backend)
     except Exception as e:
         logging.error(f"Critical error in server: {e}")
         execute_try_py()
@@ -0,0 +1,356 @@
+"""Registry of the image operations jobs can run, and pipelines built from them.
+
+Each operation declares its parameters with their defaults, the color space
+it expects and produces, and the halo it needs around a tile. A pipeline
+chains several operations and runs them on a tile in one pass, converting
+between BGR and grayscale only where a step requires it. An OutputSet runs
+several pipelines over the same tile and computes every intermediate they
+have in common (color conversions, gradients, shared leading steps) once.
+
+Operations that depend on a whole-image statistic (a histogram, a maximum)
+declare a Reduction. Each tile measures the statistic over its own core,
+the master combines the measurements and the combined value is passed to
+the operation as a parameter, so tiled output matches a whole-image run.
+"""
+import cv2
+import numpy as np
+
+REGISTRY = {}
+
+
+def gray(img, get):
+    return img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def bgr(img, get):
+    return img if img.ndim == 3 else cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+
+def gradient(img, get):
+    # Same 3x3 Sobel derivatives Canny computes internally
+    gray_img = get("gray")
+    return (cv2.Sobel(gray_img, cv2.CV_16S, 1, 0, ksize=3, borderType=cv2.BORDER_REPLICATE),
+            cv2.Sobel(gray_img, cv2.CV_16S, 0, 1, ksize=3, borderType=cv2.BORDER_REPLICATE))
+
+
+def harris(img, get):
+    return cv2.cornerHarris(get("gray"), 2, 3, 0.04)
+
+
+# Values derived from an image that several operations consume. Each is
+# computed at most once per image per tile and may build on the others
+# through get().
+INTERMEDIATES = {"gray": gray, "bgr": bgr, "gradient": gradient, "harris": harris}
+
+
+def crop(img, core):
+    # core is (y0, y1, x0, x1) within img, or None for all of it
+    if core is None:
+        return img
+    y0, y1, x0, x1 = core
+    return img[y0:y1, x0:x1]
+
+
+class Reduction:
+    def __init__(self, param, measure, combine):
+        # Parameter of the operation that receives the combined value
+        self.param = param
+        # measure(img, core, **intermediates, **params) -> statistic over core
+        self.measure = measure
+        # combine(list of statistics) -> value for param
+        self.combine = combine
+
+
+class Operation:
+    def __init__(self, name, func, params, input_space, output_space, halo, uses, reduction, finish, tile_size):
+        self.name = name
+        self.func = func
+        self.params = params
+        # "bgr", "gray" or "any"
+        self.input_space = input_space
+        # "bgr", "gray" or "same" (whatever came in)
+        self.output_space = output_space
+        # Pixels needed from neighbouring tiles: an int, a function of the
+        # step's parameters, or None when the whole image is needed
+        self.halo = halo
+        # Names from INTERMEDIATES passed to func as keyword arguments
+        self.uses = uses
+        self.reduction = reduction
+        # Applied by the master to the stitched result when this is the last step
+        self.finish = finish
+        # Preferred tile edge for expensive operations, where more and smaller
+        # tiles spread a job over more workers; None for the default
+        self.tile_size = tile_size
+
+    def get_halo(self, params):
+        return self.halo(params) if callable(self.halo) else self.halo
+
+
+def register(name, params=None, input_space="any", output_space="same", halo=0, uses=(), reduction=None,
+             finish=None, tile_size=None):
+    def decorator(func):
+        REGISTRY[name] = Operation(name, func, params or {}, input_space, output_space, halo, uses, reduction,
+                                   finish, tile_size)
+        return func
+    return decorator
+
+
+def intermediate(memo, prefix, img, name):
+    # prefix identifies img by the steps that produced it
+    key = (prefix, name)
+    if key not in memo:
+        memo[key] = INTERMEDIATES[name](img, lambda other: intermediate(memo, prefix, img, other))
+    return memo[key]
+
+
+def prepare(memo, prefix, img, operation):
+    # Converts img to the color space the operation wants and gathers its intermediates
+    if operation.input_space != "any":
+        img = intermediate(memo, prefix, img, operation.input_space)
+    return img, {name: intermediate(memo, prefix, img, name) for name in operation.uses}
+
+
+@register("none")
+def identity(img):
+    return img
+
+
+@register("grayscale", input_space="gray", output_space="gray")
+def grayscale(img):
+    # The conversion itself happens before the step runs
+    return img
+
+
+@register("blur", params={"ksize": 5}, halo=lambda params: params["ksize"] // 2)
+def blur(img, ksize):
+    return cv2.GaussianBlur(img, (ksize, ksize), 0)
+
+
+@register("edge_detection", params={"low": 100, "high": 200}, input_space="gray", output_space="gray",
+          halo=8, uses=("gradient",))  # 3x3 Sobel plus slack for hysteresis tracking
+def edge_detection(img, gradient, low, high):
+    return cv2.Canny(gradient[0], gradient[1], low, high)
+
+
+@register("thresholding", params={"threshold": 127})
+def thresholding(img, threshold):
+    _, processed_img = cv2.threshold(img, threshold, 255, cv2.THRESH_BINARY)
+    return processed_img
+
+
+def equalization_lut(histograms):
+    # The table cv2.equalizeHist builds, from the summed histogram of every tile
+    hist = np.sum(histograms, axis=0, dtype=np.int64)
+    first = int(np.flatnonzero(hist)[0])
+    total = int(hist.sum())
+    if hist[first] == total:
+        return (first,) * 256
+    scale = np.float32(255) / np.float32(total - hist[first])
+    cumulative = (np.cumsum(hist) - hist[first]).astype(np.float32)
+    lut = np.clip(np.rint(cumulative * scale), 0, 255)
+    lut[:first] = 0
+    return tuple(int(value) for value in lut)
+
+
+@register("histogram_equalization", input_space="gray", output_space="gray",
+          reduction=Reduction("lut", lambda img, core: np.bincount(crop(img, core).ravel(), minlength=256),
+                              equalization_lut))
+def histogram_equalization(img, lut):
+    return cv2.LUT(img, np.array(lut, dtype=np.uint8))
+
+
+@register("clahe", params={"clip": 2.0, "grid": 8}, input_space="gray", output_space="gray", halo=None)
+def clahe(img, clip, grid):
+    # Contrast limited equalization interpolates between neighbouring grid
+    # cells laid out over the whole image, so it runs on one tile
+    return cv2.createCLAHE(clipLimit=clip, tileGridSize=(grid, grid)).apply(img)
+
+
+def rotate(img, angle):
+    rows, cols = img.shape[:2]
+    rotation_matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), angle, 1)
+    return cv2.warpAffine(img, rotation_matrix, (cols, rows))
+
+
+@register("rotation_left", halo=None)
+def rotation_left(img):
+    return rotate(img, 90)
+
+
+@register("rotation_right", halo=None)
+def rotation_right(img):
+    return rotate(img, -90)
+
+
+@register("scaling", params={"width": None, "height": None}, halo=None)
+def scaling(img, width, height):
+    return cv2.resize(img, (width, height))
+
+
+# Harris responses are compared against the strongest response in the image
+harris_max = Reduction("response_max", lambda img, core, harris: np.array([crop(harris, core).max()]),
+                       lambda statistics: np.float32(max(statistic.max() for statistic in statistics)))
+
+
+@register("corner_detection", input_space="bgr", output_space="bgr", uses=("harris",), reduction=harris_max,
+          halo=3)  # 3x3 Sobel, 2x2 window and 3x3 dilation
+def corner_detection(img, harris, response_max):
+    dst = cv2.dilate(harris, None)
+    processed_img = img.copy()
+    processed_img[dst > 0.01 * response_max] = [0, 0, 255]  # Mark corners in red
+    return processed_img
+
+
+def corner_coordinates(mask):
+    # (x, y) of every marked pixel, row by row
+    return np.ascontiguousarray(np.argwhere(mask)[:, ::-1], dtype=np.int32)
+
+
+@register("corner_points", output_space="gray", uses=("harris",), reduction=harris_max,
+          finish=corner_coordinates, halo=2)  # 3x3 Sobel and 2x2 window
+def corner_points(img, harris, response_max):
+    # Slaves send back a mask; the master turns it into an (N, 2) array of
+    # coordinates, which is far smaller than an annotated image
+    return (harris > 0.01 * response_max).view(np.uint8)
+
+
+# (template window, search window) for each deblurring preset. Run time
+# grows with the square of the search window.
+DENOISE_PRESETS = {"fast": (5, 11), "balanced": (7, 21), "quality": (7, 35)}
+
+
+def denoise_windows(params):
+    # Explicit window sizes override the preset's
+    if params["preset"] not in DENOISE_PRESETS:
+        raise ValueError(f"Unknown deblurring preset: {params['preset']}")
+    template, search = DENOISE_PRESETS[params["preset"]]
+    return params["template"] or template, params["search"] or search
+
+
+@register("deblurring", params={"h": 10, "h_color": 10, "preset": "balanced", "template": 0, "search": 0},
+          input_space="bgr", output_space="bgr", tile_size=512,
+          halo=lambda params: sum(window // 2 for window in denoise_windows(params)))
+def deblurring(img, h, h_color, preset, template, search):
+    template, search = denoise_windows({"preset": preset, "template": template, "search": search})
+    return cv2.fastNlMeansDenoisingColored(img, None, h, h_color, template, search)
+
+
+class Pipeline:
+    def __init__(self, steps):
+        # steps is a list of (Operation, params) pairs
+        self.steps = steps
+        self.name = "->".join(operation.name for operation, _ in steps)
+        # Color space the first step wants its input in
+        self.input_space = steps[0][0].input_space
+        # Serialisable form that slaves compile again on their side
+        self.spec = [[operation.name, params] for operation, params in steps]
+        # Hashable identity of each step, for sharing results between pipelines
+        self.keys = [(operation.name, tuple(sorted(params.items()))) for operation, params in steps]
+        halos = [operation.get_halo(params) for operation, params in steps]
+        # Local steps widen each other's footprint, so their halos add up
+        self.halo = None if None in halos else sum(halos)
+        tile_sizes = [operation.tile_size for operation, _ in steps if operation.tile_size]
+        self.tile_size = min(tile_sizes) if tile_sizes else None
+
+    def __call__(self, img, memo=None):
+        # memo holds the images after each run of leading steps and their
+        # intermediates; pipelines sharing it reuse each other's work
+        memo = {} if memo is None else memo
+        prefix = ()
+        for (operation, params), key in zip(self.steps, self.keys):
+            step_prefix = prefix + (key,)
+            if step_prefix not in memo:
+                img, inputs = prepare(memo, prefix, img, operation)
+                reduction = operation.reduction
+                if reduction and reduction.param not in params:
+                    # Nothing was measured across tiles, so img is the whole image
+                    statistic = reduction.measure(img, None, **inputs, **params)
+                    params = dict(params, **{reduction.param: reduction.combine([statistic])})
+                memo[step_prefix] = operation.func(img, **inputs, **params)
+            img, prefix = memo[step_prefix], step_prefix
+        return img
+
+    def finish(self, result):
+        operation = self.steps[-1][0]
+        return operation.finish(result) if operation.finish else result
+
+    def unresolved(self):
+        # Index of the first step still waiting for a whole-image statistic
+        for index, (operation, params) in enumerate(self.steps):
+            if operation.reduction and operation.reduction.param not in params:
+                return index
+        return None
+
+    def measure(self, img, core):
+        # Runs the leading steps, then measures the last step's statistic over core
+        memo = {}
+        if len(self.steps) > 1:
+            img = Pipeline(self.steps[:-1])(img, memo)
+        operation, params = self.steps[-1]
+        img, inputs = prepare(memo, tuple(self.keys[:-1]), img, operation)
+        return operation.reduction.measure(img, core, **inputs, **params)
+
+
+class OutputSet:
+    def __init__(self, pipelines):
+        self.pipelines = pipelines
+        self.name = ",".join(pipeline.name for pipeline in pipelines)
+        self.spec = [pipeline.spec for pipeline in pipelines]
+        halos = [pipeline.halo for pipeline in pipelines]
+        # Each output is exact with its own halo, so the widest one covers all
+        self.halo = None if None in halos else max(halos)
+        tile_sizes = [pipeline.tile_size for pipeline in pipelines if pipeline.tile_size]
+        self.tile_size = min(tile_sizes) if tile_sizes else None
+
+    def __call__(self, img):
+        memo = {}
+        return [pipeline(img, memo) for pipeline in self.pipelines]
+
+
+def compile_pipeline(steps, options=None):
+    """Build a Pipeline from a list of steps.
+
+    Args:
+        steps: Operation names, an "a -> b -> c" string, or [name, params]
+            pairs.
+        options: Request parameters used for any declared parameter a step
+            does not set itself.
+
+    Returns:
+        Pipeline: Ready to call on a BGR or grayscale image.
+    """
+    if isinstance(steps, str):
+        steps = [step.strip() for step in steps.split("->")]
+    options = options or {}
+
+    compiled = []
+    for step in steps:
+        name, step_params = (step, {}) if isinstance(step, str) else step
+        if name not in REGISTRY:
+            raise ValueError(f"Unknown operation: {name}")
+        operation = REGISTRY[name]
+
+        params = {}
+        for key, default in operation.params.items():
+            value = step_params.get(key, options.get(key, default))
+            if value is None:
+                raise ValueError(f"{name} needs the {key} parameter")
+            params[key] = type(default)(value) if default is not None else int(value)
+        # Set by the master once every tile has been measured
+        if operation.reduction and operation.reduction.param in step_params:
+            params[operation.reduction.param] = step_params[operation.reduction.param]
+        compiled.append((operation, params))
+
+    if not compiled:
+        raise ValueError("A pipeline needs at least one operation")
+    return Pipeline(compiled)
+
+
+def compile_outputs(outputs, options=None):
+    """Build an OutputSet from a list of pipelines, each in any form
+    compile_pipeline accepts."""
+    if not isinstance(outputs, list):
+        raise ValueError(f"outputs must be a list of pipelines, not {type(outputs).__name__}")
+    if not outputs:
+        raise ValueError("At least one output is needed")
+    return OutputSet([compile_pipeline(steps, options) for steps in outputs])
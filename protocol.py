@@ -0,0 +1,162 @@
+"""Binary framing shared by client.py and master-node4.py.
+
+Every message is a fixed-size header, a JSON parameter block and a payload:
+
+    magic        4s   b"DCVP"
+    version      B    VERSION
+    kind         B    MSG_REQUEST, MSG_RESPONSE, MSG_BATCH_REQUEST or MSG_BATCH_DONE
+    operation    H    index into OPERATIONS
+    request_id   16s  UUID chosen by the client, echoed in the response
+    status       B    STATUS_OK or STATUS_ERROR
+    params_len   I    length of the JSON parameter block
+    payload_len  Q    length of the payload (image bytes)
+
+Both sides read exact byte counts, so nothing is scanned for markers and a
+request/response pair costs a single round trip. Payloads are received into
+a preallocated bytearray that np.frombuffer can wrap without copying: from a
+socket with recv_into, and from an asyncio stream one buffered chunk at a
+time, so the stream never holds a whole payload of its own. Frames larger
+than MAX_PARAMS_LEN or MAX_PAYLOAD_LEN are refused before anything is
+allocated for them.
+"""
+import asyncio
+import json
+import struct
+from collections import namedtuple
+
+MAGIC = b"DCVP"
+VERSION = 1
+
+HEADER = struct.Struct("!4sBBH16sBIQ")
+
+# Largest parameter block and payload a peer may announce
+MAX_PARAMS_LEN = 1024 * 1024
+MAX_PAYLOAD_LEN = 4 * 1024 * 1024 * 1024
+
+# Most bytes taken from an asyncio stream's buffer at once
+STREAM_CHUNK = 1024 * 1024
+
+MSG_REQUEST = 1
+# A request with several "outputs" gets one response whose payload holds
+# every result back to back; its "outputs" parameter describes each in
+# order, with its byte "length".
+MSG_RESPONSE = 2
+# A batch request carries several images back to back in its payload, with
+# their lengths in the "items" parameter and the operations to run on each
+# in "operations". Every (image, operation) result comes back as its own
+# MSG_RESPONSE tagged with its "item" index as soon as it is ready, and
+# MSG_BATCH_DONE closes the batch.
+MSG_BATCH_REQUEST = 3
+MSG_BATCH_DONE = 4
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+# Append only: the position of each name is its id on the wire
+OPERATIONS = [
+    "none",
+    "grayscale",
+    "blur",
+    "edge_detection",
+    "thresholding",
+    "histogram_equalization",
+    "rotation_left",
+    "rotation_right",
+    "scaling",
+    "corner_detection",
+    "deblurring",
+    "clahe",
+    "corner_points",
+]
+OPERATION_IDS = {name: index for index, name in enumerate(OPERATIONS)}
+
+Message = namedtuple("Message", ["kind", "operation", "request_id", "status", "params", "payload"])
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def pack_header(kind, operation, request_id, params, payload_len, status=STATUS_OK):
+    # Returns the fixed header followed by the JSON parameter block
+    if operation not in OPERATION_IDS:
+        raise ProtocolError(f"Unknown operation: {operation}")
+    params_data = json.dumps(params or {}).encode()
+    header = HEADER.pack(MAGIC, VERSION, kind, OPERATION_IDS[operation], request_id, status,
+                         len(params_data), payload_len)
+    return header + params_data
+
+
+def unpack_header(data):
+    magic, version, kind, operation_id, request_id, status, params_len, payload_len = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ProtocolError("Bad magic; peer is not speaking this protocol")
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if operation_id >= len(OPERATIONS):
+        raise ProtocolError(f"Unknown operation id {operation_id}")
+    if params_len > MAX_PARAMS_LEN:
+        raise ProtocolError(f"Parameter block of {params_len} bytes exceeds the {MAX_PARAMS_LEN} byte limit")
+    if payload_len > MAX_PAYLOAD_LEN:
+        raise ProtocolError(f"Payload of {payload_len} bytes exceeds the {MAX_PAYLOAD_LEN} byte limit")
+    return kind, OPERATIONS[operation_id], request_id, status, params_len, payload_len
+
+
+def send_header(sock, kind, operation, request_id, params, payload_len, status=STATUS_OK):
+    sock.sendall(pack_header(kind, operation, request_id, params, payload_len, status))
+
+
+def send_message(sock, kind, operation, request_id, params, payload, status=STATUS_OK):
+    send_header(sock, kind, operation, request_id, params, len(payload), status)
+    sock.sendall(payload)
+
+
+def recv_into_exactly(sock, view):
+    # Fill a writable memoryview straight from the socket, no intermediate chunks
+    received = 0
+    while received < len(view):
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ProtocolError(f"Connection closed with {len(view) - received} of {len(view)} bytes outstanding")
+        received += count
+
+
+def recv_exactly(sock, length):
+    buffer = bytearray(length)
+    recv_into_exactly(sock, memoryview(buffer))
+    return buffer
+
+
+def recv_message(sock):
+    kind, operation, request_id, status, params_len, payload_len = unpack_header(recv_exactly(sock, HEADER.size))
+    params = json.loads(recv_exactly(sock, params_len)) if params_len else {}
+    payload = recv_exactly(sock, payload_len)
+    return Message(kind, operation, request_id, status, params, payload)
+
+
+async def read_into_exactly(reader, view):
+    # Fill a writable memoryview from a StreamReader. readexactly would
+    # gather the whole payload in the stream's buffer and then copy it out.
+    received = 0
+    while received < len(view):
+        chunk = await reader.read(min(len(view) - received, STREAM_CHUNK))
+        if not chunk:
+            raise asyncio.IncompleteReadError(b"", len(view))
+        view[received:received + len(chunk)] = chunk
+        received += len(chunk)
+
+
+async def read_message(reader):
+    # asyncio counterpart of recv_message for a StreamReader
+    kind, operation, request_id, status, params_len, payload_len = unpack_header(
+        await reader.readexactly(HEADER.size))
+    params = json.loads(await reader.readexactly(params_len)) if params_len else {}
+    payload = bytearray(payload_len)
+    await read_into_exactly(reader, memoryview(payload))
+    return Message(kind, operation, request_id, status, params, payload)
+
+
+async def write_message(writer, kind, operation, request_id, params, payload, status=STATUS_OK):
+    writer.write(pack_header(kind, operation, request_id, params, len(payload), status))
+    writer.write(payload)
+    await writer.drain()
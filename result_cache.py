@@ -0,0 +1,207 @@
+"""Content-addressed cache of encoded results, kept by the master.
+
+A result is addressed by a hash of the uploaded image bytes, the operation
+and the request parameters that shape the output, so a retried request or a
+duplicate upload is answered without running the job again. Recently used
+results stay in memory up to a byte budget. Results pushed out of memory
+spill to files in a cache directory, which has its own byte budget and
+outlives the process. Both tiers evict the least recently used entry first.
+
+An entry is the list of (data, params) pairs a job encoded, one per output.
+On disk it is a 4-byte length, the JSON list of params (each with its
+"length") and the data back to back.
+"""
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+LENGTH = struct.Struct("!I")
+
+
+def content_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_key(digest, operation, params, ignored=(), version=""):
+    # digest is the content_digest of the input image. Parameters that only
+    # change how a job runs or where its output goes are left out, so they
+    # do not split otherwise identical results. version names the code and
+    # defaults that produced a result; disk entries written under another
+    # version are never looked up again and age out.
+    shaping = {name: value for name, value in params.items() if name not in ignored}
+    description = json.dumps([version, digest, operation, shaping], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def entry_size(entry):
+    return sum(len(data) for data, _ in entry)
+
+
+def copy_entry(entry):
+    return [(data, dict(params)) for data, params in entry]
+
+
+class ResultCache:
+    def __init__(self, memory_bytes, disk_bytes, directory, version=""):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.directory = directory
+        self.version = version
+        # key -> entry and key -> file size, least recently used first
+        self.memory = OrderedDict()
+        self.disk = OrderedDict()
+        self.memory_used = 0
+        self.disk_used = 0
+        self.counts = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        # Lookups and stores come from executor threads. The lock covers the
+        # indexes only; files are read and written outside it.
+        self.lock = threading.Lock()
+
+        if disk_bytes:
+            os.makedirs(directory, exist_ok=True)
+            # Files left by an earlier run, oldest first
+            files = [entry for entry in os.scandir(directory) if entry.is_file() and not entry.name.endswith(".tmp")]
+            for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+                self.disk[entry.name] = entry.stat().st_size
+                self.disk_used += self.disk[entry.name]
+            self.remove_files(self.trim_disk())
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        # Returns the entry with fresh params dicts, which callers annotate
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                self.counts["memory_hits"] += 1
+                return copy_entry(entry)
+            if key not in self.disk:
+                self.counts["misses"] += 1
+                return None
+
+        entry = self.read(key)
+        with self.lock:
+            if entry is None:
+                self.counts["misses"] += 1
+                return None
+            self.counts["disk_hits"] += 1
+            if key in self.disk:
+                self.disk.move_to_end(key)
+            evicted = [] if key in self.memory else self.remember(key, entry)
+        self.spill_all(evicted)
+        return copy_entry(entry)
+
+    def put(self, key, entry):
+        entry = copy_entry(entry)
+        with self.lock:
+            self.counts["stores"] += 1
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                evicted = []
+            elif entry_size(entry) <= self.memory_bytes:
+                evicted = self.remember(key, entry)
+            else:
+                evicted = [(key, entry)]
+        self.spill_all(evicted)
+
+    def remember(self, key, entry):
+        # Called with the lock held; returns the entries pushed out of memory
+        self.memory[key] = entry
+        self.memory_used += entry_size(entry)
+        evicted = []
+        while self.memory_used > self.memory_bytes:
+            evicted_key, evicted_entry = self.memory.popitem(last=False)
+            self.memory_used -= entry_size(evicted_entry)
+            self.counts["evictions"] += 1
+            evicted.append((evicted_key, evicted_entry))
+        return evicted
+
+    def spill_all(self, evicted):
+        for key, entry in evicted:
+            self.spill(key, entry)
+
+    def spill(self, key, entry):
+        with self.lock:
+            if key in self.disk:
+                self.disk.move_to_end(key)
+                return
+        header = json.dumps([dict(params, length=len(data)) for data, params in entry]).encode()
+        size = LENGTH.size + len(header) + entry_size(entry)
+        if size > self.disk_bytes:
+            return
+
+        # Written under another name first so readers never see half a file
+        temporary = f"{self.path(key)}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary, "wb") as f:
+                f.write(LENGTH.pack(len(header)))
+                f.write(header)
+                for data, _ in entry:
+                    f.write(data)
+            os.replace(temporary, self.path(key))
+        except OSError as e:
+            logging.warning(f"Could not write cached result {key}: {e}")
+            return
+        with self.lock:
+            if key not in self.disk:
+                self.disk[key] = size
+                self.disk_used += size
+            removed = self.trim_disk()
+        self.remove_files(removed)
+
+    def read(self, key):
+        try:
+            with open(self.path(key), "rb") as f:
+                contents = f.read()
+        except OSError:
+            # Evicted since the lookup, or lost to an eviction racing a rewrite
+            with self.lock:
+                if key in self.disk:
+                    self.disk_used -= self.disk.pop(key)
+            return None
+        try:
+            (header_length,) = LENGTH.unpack_from(contents)
+            offset = LENGTH.size + header_length
+            entry = []
+            for params in json.loads(contents[LENGTH.size:offset]):
+                length = params.pop("length")
+                entry.append((memoryview(contents)[offset:offset + length], params))
+                offset += length
+        except (ValueError, KeyError, struct.error) as e:
+            logging.warning(f"Dropping unreadable cached result {key}: {e}")
+            with self.lock:
+                if key in self.disk:
+                    self.disk_used -= self.disk.pop(key)
+            self.remove_files([key])
+            return None
+        return entry
+
+    def trim_disk(self):
+        # Called with the lock held; returns the keys whose files should go
+        removed = []
+        while self.disk_used > self.disk_bytes:
+            key, size = self.disk.popitem(last=False)
+            self.disk_used -= size
+            removed.append(key)
+        return removed
+
+    def remove_files(self, keys):
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counts["memory_hits"] + self.counts["disk_hits"] + self.counts["misses"]
+            hits = lookups - self.counts["misses"]
+            return dict(self.counts, hit_rate=round(hits / lookups, 3) if lookups else 0.0,
+                        memory_bytes=self.memory_used, memory_entries=len(self.memory),
+                        disk_bytes=self.disk_used, disk_entries=len(self.disk))